@@ -8,7 +8,9 @@ from app.services import auth
 from app.core.dependencies import get_current_active_user
 from app.models.user import User
 from app.core.security import decode_token
+from app.core.responses import MsgspecResponse
 from app.utils.exceptions import AuthError
+from app.utils.openapi import msgspec_responses
 
 router = APIRouter()
 
@@ -16,16 +18,16 @@ router = APIRouter()
 async def register_user_endpoint(user_in: UserCreate):
     return await auth.register_user_email_password(user_in=user_in)
 
-@router.post("/login/email", response_model=Token)
+@router.post("/login/email", response_class=MsgspecResponse, responses=msgspec_responses(Token))
 async def login_for_access_token_email(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
-    return await auth.login_email_password(form_data=form_data)
+    return MsgspecResponse(await auth.login_email_password(form_data=form_data))
 
-@router.post("/token/refresh", response_model=Token)
+@router.post("/token/refresh", response_class=MsgspecResponse, responses=msgspec_responses(Token))
 async def refresh_token_endpoint(refresh_token: str = Query(..., description="The refresh token")):
     token_payload = decode_token(refresh_token)
     if not token_payload or token_payload.type != "refresh":
         raise AuthError(detail="Invalid refresh token", error_code="INVALID_REFRESH_TOKEN_TYPE")
-    return await auth.refresh_access_token(token_payload.model_dump())
+    return MsgspecResponse(await auth.refresh_access_token(token_payload))
 
 
 @router.get("/google/login")
@@ -33,7 +35,7 @@ async def google_login_authorize(request: Request):
     authorize_url = await auth.get_google_oauth_authorize_url(request)
     return {"authorize_url": authorize_url} # Or RedirectResponse(authorize_url)
 
-@router.get("/google/callback", response_model=Token)
+@router.get("/google/callback", response_class=MsgspecResponse, responses=msgspec_responses(Token))
 async def google_login_callback(request: Request, code: str = Query(...)):
     # The frontend should ideally exchange this code for tokens by calling this endpoint.
     # Or, if this backend handles the redirect directly:
@@ -41,7 +43,7 @@ async def google_login_callback(request: Request, code: str = Query(...)):
     # response = RedirectResponse(url="/frontend-redirect-path-after-login") # Redirect to frontend
     # response.set_cookie(key="access_token", value=token.access_token, httponly=True, samesite="lax") # Example for cookies
     # return response
-    return await auth.handle_google_oauth_callback(request, code)
+    return MsgspecResponse(await auth.handle_google_oauth_callback(request, code))
 
 @router.post("/logout")
 async def logout(current_user: Annotated[User, Depends(get_current_active_user)]):
@@ -1,18 +1,24 @@
 from fastapi import APIRouter, Depends, UploadFile, File, Form
 from fastapi.responses import StreamingResponse
-from typing import Annotated
-import io
+from typing import Annotated, AsyncIterator
 
 from app.models.user import User
-from app.core.dependencies import get_current_active_user, FaceSwapAccessChecker
+from app.core.dependencies import require_faceswap_access
 from app.services.faceswap import faceswap_processor
 from app.utils.exceptions import InvalidInputError
 
 router = APIRouter()
 
-@router.post("/process", dependencies=[Depends(FaceSwapAccessChecker())])
+RESULT_CHUNK_SIZE = 64 * 1024
+
+async def _iter_result_chunks(result_image_bytes: bytes) -> AsyncIterator[bytes]:
+    # Async generator so Starlette streams chunks directly instead of going through its threadpool.
+    for offset in range(0, len(result_image_bytes), RESULT_CHUNK_SIZE):
+        yield result_image_bytes[offset:offset + RESULT_CHUNK_SIZE]
+
+@router.post("/process")
 async def process_faceswap_endpoint(
-    current_user: Annotated[User, Depends(get_current_active_user)], # Dependency ensures user is active
+    current_user: Annotated[User, Depends(require_faceswap_access)], # Authenticates, ensures user is active and checks access
     source_image: Annotated[UploadFile, File(description="The source image containing the face to swap.")],
     target_image: Annotated[UploadFile, File(description="The target image where the face will be placed.")]
 ):
@@ -20,18 +26,16 @@ async def process_faceswap_endpoint(
        not target_image.content_type.startswith("image/"):
         raise InvalidInputError(detail="Both files must be images.", error_code="INVALID_FILE_TYPE")
 
-    source_image_data = await source_image.read()
-    target_image_data = await target_image.read()
-
-    if not source_image_data or not target_image_data:
+    if not source_image.size or not target_image.size:
         raise InvalidInputError(detail="Image data could not be read or is empty.", error_code="EMPTY_IMAGE_DATA")
 
-    # The FaceSwapAccessChecker dependency already performed checks.
+    # The require_faceswap_access dependency already performed checks and returned the user.
     # The faceswap_processor.process_swap will handle the core logic and update counts.
+    # The spooled upload files are handed over as-is rather than copied into bytes here.
     result_image_bytes = await faceswap_processor.process_swap(
         user=current_user,
-        source_image_data=source_image_data,
-        target_image_data=target_image_data
+        source_image=source_image.file,
+        target_image=target_image.file
     )
 
-    return StreamingResponse(io.BytesIO(result_image_bytes), media_type="image/png") # Adjust media_type if known
\ No newline at end of file
+    return StreamingResponse(_iter_result_chunks(result_image_bytes), media_type="image/png") # Adjust media_type if known
\ No newline at end of file
@@ -1,21 +1,28 @@
-from fastapi import APIRouter, Depends, Request, BackgroundTasks, Query
-from typing import Annotated
+from fastapi import APIRouter, Depends, Request, BackgroundTasks, Query, Header
+from typing import Annotated, Optional
 import uuid # Standard Python UUID
 
 from app.models.user import User
-from app.core.dependencies import get_current_active_user
+from app.core.dependencies import get_current_active_user, msgspec_body
+from app.core.responses import MsgspecResponse
 from app.services import payment # payment will now have paystack functions
 from app.schemas.payment_schemas import (
     CreateCardPaymentRequest, PaystackInitializationResponse, # Changed Stripe to Paystack
     CreateUSDTTransactionRequest, USDTTransactionResponse, PaymentStatusResponse
 )
-from app.utils.exceptions import AppLogicError
+from app.utils.exceptions import AppLogicError, InvalidInputError
+from app.utils.openapi import msgspec_request_body, msgspec_responses
+from app.utils.validators import is_valid_tx_hash
 
 router = APIRouter()
 
-@router.post("/paystack/initialize-payment", response_model=PaystackInitializationResponse)
+@router.post(
+    "/paystack/initialize-payment", response_class=MsgspecResponse,
+    responses=msgspec_responses(PaystackInitializationResponse),
+    openapi_extra=msgspec_request_body(CreateCardPaymentRequest),
+)
 async def initialize_paystack_checkout( # Renamed from create_stripe_checkout
-    payload: CreateCardPaymentRequest, # Reusing schema, name changed for clarity
+    payload: Annotated[CreateCardPaymentRequest, Depends(msgspec_body(CreateCardPaymentRequest))], # Reusing schema, name changed for clarity
     current_user: Annotated[User, Depends(get_current_active_user)],
     request: Request
 ):
@@ -29,11 +36,11 @@ async def initialize_paystack_checkout( # Renamed from create_stripe_checkout
     # In a real app, frontend might send its specific base callback URL.
     base_frontend_callback_url = str(request.base_url).rstrip('/')
 
-    return await payment.initialize_paystack_payment(
+    return MsgspecResponse(await payment.initialize_paystack_payment(
         user=current_user,
         payment_type=payload.payment_type,
         base_callback_url=base_frontend_callback_url # This is the base URL for the frontend page that handles Paystack callback
-    )
+    ))
 
 @router.get("/paystack/verify-payment", response_model=PaymentStatusResponse)
 async def verify_paystack_payment_endpoint( # Renamed from verify_stripe_payment_endpoint
@@ -42,11 +49,25 @@ async def verify_paystack_payment_endpoint( # Renamed from verify_stripe_payment
 ):
     return await payment.verify_paystack_payment(reference=reference, user=current_user)
 
+@router.post("/paystack/webhook")
+async def paystack_webhook_endpoint(
+    request: Request,
+    x_paystack_signature: Optional[str] = Header(default=None)
+):
+    await payment.handle_paystack_webhook(
+        payload=await request.body(),
+        signature=x_paystack_signature
+    )
+    return {"status": "ok"}
+
 
 # USDT Endpoints remain unchanged
-@router.post("/usdt/initiate-payment", response_model=USDTTransactionResponse)
+@router.post(
+    "/usdt/initiate-payment", response_model=USDTTransactionResponse,
+    openapi_extra=msgspec_request_body(CreateUSDTTransactionRequest),
+)
 async def initiate_usdt_payment_endpoint(
-    payload: CreateUSDTTransactionRequest,
+    payload: Annotated[CreateUSDTTransactionRequest, Depends(msgspec_body(CreateUSDTTransactionRequest))],
     current_user: Annotated[User, Depends(get_current_active_user)]
 ):
     return await payment.initiate_usdt_payment(user=current_user, payment_type=payload.payment_type)
@@ -54,18 +75,22 @@ async def initiate_usdt_payment_endpoint(
 @router.post("/usdt/confirm-payment", response_model=PaymentStatusResponse)
 async def confirm_usdt_payment_endpoint(
     current_user: Annotated[User, Depends(get_current_active_user)], # Moved before parameters with defaults
-    background_tasks: BackgroundTasks, # Moved before parameters with defaults
     payment_attempt_id: uuid.UUID = Query(..., description="Internal payment attempt ID"),
     transaction_hash: str = Query(..., description="USDT transaction hash from the blockchain")
 ):
-    # Validation of transaction_hash format is now in the service layer
+    # Reject malformed hashes before the service touches the payment attempt
+    if not is_valid_tx_hash(transaction_hash):
+        raise InvalidInputError(detail="Invalid transaction hash format.", error_code="INVALID_TX_HASH")
+
     return await payment.confirm_usdt_payment(
         user=current_user,
         payment_attempt_id=payment_attempt_id,
-        transaction_hash=transaction_hash,
-        background_tasks=background_tasks
+        transaction_hash=transaction_hash.lower() # Hex case varies by wallet; store one form for the unique index
     )
 
 @router.get("/status", response_model=PaymentStatusResponse)
-async def get_payment_status_endpoint(current_user: Annotated[User, Depends(get_current_active_user)]):
-    return await payment.get_user_payment_status(user=current_user)
\ No newline at end of file
+async def get_payment_status_endpoint(
+    current_user: Annotated[User, Depends(get_current_active_user)],
+    background_tasks: BackgroundTasks
+):
+    return await payment.get_user_payment_status(user=current_user, background_tasks=background_tasks)
\ No newline at end of file
@@ -7,4 +7,11 @@ api_router_v1 = APIRouter()
 api_router_v1.include_router(auth.router, prefix="/auth", tags=["Authentication"])
 api_router_v1.include_router(user.router, prefix="/users", tags=["Users"])
 api_router_v1.include_router(payment.router, prefix="/payments", tags=["Payments & Subscriptions"])
-api_router_v1.include_router(faceswap.router, prefix="/faceswap", tags=["FaceSwap Service"])
\ No newline at end of file
+api_router_v1.include_router(faceswap.router, prefix="/faceswap", tags=["FaceSwap Service"])
+
+# There is exactly one module per router; fail fast if one is ever included twice,
+# which would register duplicate routes and resolve their dependencies twice per hit.
+_route_keys = [(route.path, tuple(sorted(route.methods or ()))) for route in api_router_v1.routes]
+_duplicate_route_keys = sorted({key for key in _route_keys if _route_keys.count(key) > 1})
+if _duplicate_route_keys:
+    raise RuntimeError(f"Duplicate routes registered on api_router_v1: {_duplicate_route_keys}")
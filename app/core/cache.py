@@ -0,0 +1,6 @@
+from cachetools import TTLCache
+
+# Successfully decoded access tokens, keyed by the raw bearer token string. Tokens are
+# already high-entropy, so str's built-in hash is enough and no digest is computed per request.
+# Failed validations are never stored here.
+token_cache: TTLCache = TTLCache(maxsize=10000, ttl=30)
\ No newline at end of file
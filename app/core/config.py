@@ -1,6 +1,7 @@
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pydantic import MongoDsn, AnyHttpUrl
 from typing import List, Optional
+from types import SimpleNamespace
 
 class Settings(BaseSettings):
     PROJECT_NAME: str = "FaceSwap SaaS"
@@ -39,4 +40,6 @@ class Settings(BaseSettings):
 
     model_config = SettingsConfigDict(env_file=".env", extra='ignore')
 
-settings = Settings()
\ No newline at end of file
+# Parse and validate once, then expose plain attributes so hot-path reads never go back
+# through the pydantic model. URL fields are dumped as plain strings.
+settings = SimpleNamespace(**Settings().model_dump(mode="json"))
\ No newline at end of file
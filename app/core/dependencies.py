@@ -1,23 +1,70 @@
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, status, Request
 from fastapi.security import OAuth2PasswordBearer
-from typing import Optional, Annotated
+from typing import Optional, Annotated, Type, TypeVar, Callable, Awaitable
 
 from app.core.security import decode_token
 from app.schemas.token_schemas import TokenPayload
 from app.models.user import User
-from app.repositories.user import get_user_by_id
-from app.utils.exceptions import AuthError, ForbiddenError, PaymentRequiredError
+from app.repositories.user import get_user_by_id, refresh_access_state
+from app.services.counter_batcher import counter_batcher
+from app.utils.exceptions import AuthError, ForbiddenError, PaymentRequiredError, InvalidInputError
 from app.core.config import settings
-from datetime import datetime
+from app.core.cache import token_cache
+from app.utils.clock import cached_utcnow
+import time
+import msgspec
+import uuid
 
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl=f"{settings.API_V1_STR}/auth/login/email")
+class BearerTokenScheme(OAuth2PasswordBearer):
+    # Fast path for the usual "Bearer <token>" header. Anything else (other casing, missing
+    # header) falls back to the stock parsing and its 401 "Not authenticated" response.
+    async def __call__(self, request: Request) -> Optional[str]:
+        authorization = request.headers.get("authorization")
+        if authorization is not None and authorization[:7] == "Bearer ":
+            return authorization[7:]
+        return await super().__call__(request)
+
+oauth2_scheme = BearerTokenScheme(tokenUrl=f"{settings.API_V1_STR}/auth/login/email")
+
+StructT = TypeVar("StructT", bound=msgspec.Struct)
+
+def msgspec_body(struct_type: Type[StructT]) -> Callable[[Request], Awaitable[StructT]]:
+    # Dependency factory decoding a JSON request body straight into a msgspec Struct.
+    decoder = msgspec.json.Decoder(struct_type)
+
+    async def _decode_body(request: Request) -> StructT:
+        try:
+            return decoder.decode(await request.body())
+        except msgspec.DecodeError as e: # Also covers msgspec.ValidationError
+            raise InvalidInputError(detail=str(e), error_code="VALIDATION_ERROR")
+
+    return _decode_body
+
+def _cached_decode_token(token: str) -> Optional[TokenPayload]:
+    token_payload = token_cache.get(token)
+    # A cached payload may outlive the token's own expiry, so re-check it on every hit.
+    if token_payload is not None and (token_payload.exp is None or token_payload.exp > time.time()):
+        return token_payload
+
+    token_payload = decode_token(token) # Raises AuthError on failure, so failures are never cached
+    if token_payload:
+        token_cache[token] = token_payload
+    return token_payload
+
+async def _get_user_with_pending(user_id: uuid.UUID) -> Optional[User]:
+    # One read per request: a user cached per worker would still need its access state reloaded,
+    # since payments, deactivation and usage on other workers change it.
+    user = await get_user_by_id(user_id=user_id)
+    if user:
+        counter_batcher.apply_pending(user)
+    return user
 
 async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]) -> User:
-    token_payload = decode_token(token)
+    token_payload = _cached_decode_token(token)
     if not token_payload or token_payload.type != "access":
         raise AuthError(detail="Invalid access token", error_code="INVALID_ACCESS_TOKEN")
     
-    user = await get_user_by_id(user_id=token_payload.sub)
+    user = await _get_user_with_pending(token_payload.sub)
     if not user:
         raise AuthError(detail="User not found", error_code="USER_NOT_FOUND")
     if not user.is_active:
@@ -28,32 +75,39 @@ async def get_current_active_user(current_user: Annotated[User, Depends(get_curr
     return current_user
 
 
-class FaceSwapAccessChecker:
-    def __init__(self, required: bool = True):
-        self.required = required
+def faceswap_access(required: bool = True) -> Callable[[str], Awaitable[User]]:
+    # Builds the faceswap access dependency. `required` is bound in the closure, so each call
+    # reads it as a free variable instead of an attribute on an instance.
 
-    async def __call__(self, current_user: Annotated[User, Depends(get_current_active_user)]) -> User:
-        if not self.required:
+    # Depends on the bearer token directly and resolves the user inline, so FastAPI does not
+    # walk the get_current_active_user -> get_current_user chain separately for this route.
+    async def _check_faceswap_access(token: Annotated[str, Depends(oauth2_scheme)]) -> User:
+        current_user = await get_current_user(token)
+
+        # Recomputed in memory on every check, in both modes, so optional callers also see a
+        # current tier: a stored tier may be missing (older documents) or a monthly subscription
+        # may have lapsed, and refresh_access_state copes with a missing or timezone-aware
+        # subscription_end_date.
+        refresh_access_state(current_user, now=cached_utcnow())
+        if not required:
             return current_user
 
-        is_paid_user = current_user.subscription_type == "one_time" or \
-                       (current_user.subscription_type == "monthly" and \
-                        current_user.subscription_end_date and \
-                        current_user.subscription_end_date > datetime.utcnow())
-
-        if is_paid_user:
-            if current_user.subscription_type == "monthly":
-                if current_user.monthly_requests_used >= settings.MONTHLY_REQUEST_LIMIT:
-                    raise PaymentRequiredError(
-                        detail="Monthly request limit reached. Please wait for the next cycle or upgrade.",
-                        error_code="MONTHLY_LIMIT_REACHED"
-                    )
+        # Only one_time access is unmetered; a missing count on any other tier is denied.
+        if current_user.effective_tier == "one_time" or (current_user.requests_remaining or 0) > 0:
             return current_user
 
-        if current_user.free_requests_used >= settings.FREE_REQUEST_LIMIT:
+        if current_user.effective_tier == "monthly":
             raise PaymentRequiredError(
-                detail=f"Free request limit of {settings.FREE_REQUEST_LIMIT} reached. Please subscribe for continued use.",
-                error_code="FREE_LIMIT_REACHED_PAYMENT_REQUIRED"
+                detail="Monthly request limit reached. Please wait for the next cycle or upgrade.",
+                error_code="MONTHLY_LIMIT_REACHED"
             )
-        
-        return current_user
\ No newline at end of file
+        raise PaymentRequiredError(
+            detail=f"Free request limit of {settings.FREE_REQUEST_LIMIT} reached. Please subscribe for continued use.",
+            error_code="FREE_LIMIT_REACHED_PAYMENT_REQUIRED"
+        )
+
+    return _check_faceswap_access
+
+# Built once at import; endpoints depend on these instances.
+require_faceswap_access = faceswap_access(required=True)
+optional_faceswap_access = faceswap_access(required=False)
\ No newline at end of file
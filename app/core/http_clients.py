@@ -0,0 +1,34 @@
+import httpx
+from typing import Optional
+
+from app.core.config import settings
+
+# Shared Paystack client, opened and closed by the app lifespan so every API call
+# reuses pooled TLS connections instead of handshaking per request.
+paystack_client: Optional[httpx.AsyncClient] = None
+
+async def open_paystack_client():
+    global paystack_client
+    # Bodies are pre-encoded with orjson and sent as content=, so the JSON content type is a client default
+    headers = {"Content-Type": "application/json"}
+    if settings.PAYSTACK_SECRET_KEY:
+        headers["Authorization"] = f"Bearer {settings.PAYSTACK_SECRET_KEY}"
+    paystack_client = httpx.AsyncClient(
+        base_url=settings.PAYSTACK_API_URL,
+        headers=headers,
+        timeout=10.0,
+        http2=True, # Concurrent verifies share multiplexed streams to the single Paystack origin
+        # Enough keep-alive connections that a burst of payments doesn't fall back to fresh handshakes
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=40, keepalive_expiry=30),
+    )
+
+async def close_paystack_client():
+    global paystack_client
+    if paystack_client:
+        await paystack_client.aclose()
+        paystack_client = None
+
+def get_paystack_client() -> httpx.AsyncClient:
+    if paystack_client is None:
+        raise RuntimeError("Paystack client not initialized. Call open_paystack_client first.")
+    return paystack_client
@@ -0,0 +1,13 @@
+from fastapi.responses import Response
+from typing import Any
+import msgspec
+
+_encoder = msgspec.json.Encoder()
+
+class MsgspecResponse(Response):
+    # Encodes msgspec Structs (and plain JSON-compatible values) straight to bytes. Endpoints
+    # return it directly so FastAPI skips jsonable_encoder and response_model validation.
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return _encoder.encode(content)
\ No newline at end of file
@@ -1,7 +1,8 @@
 from datetime import datetime, timedelta, timezone
-from typing import Optional, Any, Union
+from typing import Optional, Any, Union, Tuple
 
-from jose import JWTError, jwt
+import jwt
+from jwt import PyJWTError
 from passlib.context import CryptContext
 from pydantic import ValidationError
 
@@ -9,9 +10,14 @@ from app.core.config import settings
 from app.utils.exceptions import AuthError
 from app.schemas.token_schemas import TokenPayload
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# New hashes use argon2; existing bcrypt hashes still verify and are flagged for rehash on login.
+pwd_context = CryptContext(schemes=["argon2", "bcrypt"], deprecated="auto")
+# Resolve the default scheme handler and load its backend once at import, not on every hash call
+_default_hasher = pwd_context.handler()
+_default_hasher.get_backend()
 
 ALGORITHM = settings.ALGORITHM
+_DECODE_ALGORITHMS = [ALGORITHM]
 
 def create_access_token(subject: Union[str, Any], expires_delta: Optional[timedelta] = None) -> str:
     if expires_delta:
@@ -33,15 +39,30 @@ def create_refresh_token(subject: Union[str, Any], expires_delta: Optional[timed
     encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+def create_token_pair(subject: Union[str, Any]) -> Tuple[str, str]:
+    # HS256 signing takes microseconds, so both tokens are signed inline rather than in threads
+    now = datetime.now(timezone.utc)
+    sub = str(subject)
+    access_token = jwt.encode(
+        {"exp": now + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES), "sub": sub, "type": "access"},
+        settings.SECRET_KEY, algorithm=ALGORITHM
+    )
+    refresh_token = jwt.encode(
+        {"exp": now + timedelta(days=settings.REFRESH_TOKEN_EXPIRE_DAYS), "sub": sub, "type": "refresh"},
+        settings.SECRET_KEY, algorithm=ALGORITHM
+    )
+    return access_token, refresh_token
+
+def verify_and_update_password(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    # Returns (verified, new_hash); new_hash is set when the stored hash uses a deprecated scheme.
+    return pwd_context.verify_and_update(plain_password, hashed_password)
 
 def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+    return _default_hasher.hash(password)
 
 def decode_token(token: str) -> Optional[TokenPayload]:
     try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=_DECODE_ALGORITHMS)
         return TokenPayload(**payload)
-    except (JWTError, ValidationError):
+    except (PyJWTError, ValidationError):
         raise AuthError(detail="Could not validate credentials", error_code="INVALID_TOKEN")
\ No newline at end of file
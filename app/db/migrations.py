@@ -0,0 +1,69 @@
+import logging
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from app.models.payment import PaymentAttempt, Subscription
+
+logger = logging.getLogger(__name__)
+
+# payment_attempts.transaction_id and subscriptions.user.$id only became unique after data was
+# already stored, and init_beanie cannot build a unique index over duplicates. Until each index
+# exists, connect_to_mongo runs the matching step below first; once it exists, the step is a no-op.
+DUPLICATE_SUBSCRIPTIONS_COLLECTION = "subscriptions_duplicates"
+
+async def _has_unique_index(collection, key: str) -> bool:
+    for index in (await collection.index_information()).values():
+        if index.get("unique") and [field for field, _ in index["key"]] == [key]:
+            return True
+    return False
+
+async def dedupe_payment_attempt_transaction_ids(database: AsyncIOMotorDatabase) -> int:
+    # Per duplicated transaction_id the succeeded (else the oldest) attempt keeps it; the others move
+    # it to metadata.duplicate_transaction_id, which the partial unique index does not cover.
+    collection = database[PaymentAttempt.Settings.name]
+    if await _has_unique_index(collection, "transaction_id"):
+        return 0
+    moved = 0
+    groups = collection.aggregate([
+        {"$match": {"transaction_id": {"$type": "string"}}},
+        {"$sort": {"created_at": 1}},
+        {"$group": {"_id": "$transaction_id", "attempts": {"$push": {"_id": "$_id", "status": "$status", "metadata": "$metadata"}}}},
+        {"$match": {"attempts.1": {"$exists": True}}},
+    ])
+    async for group in groups:
+        attempts = group["attempts"]
+        keeper = next((attempt for attempt in attempts if attempt.get("status") == "succeeded"), attempts[0])
+        for attempt in attempts:
+            if attempt is keeper:
+                continue
+            metadata = {**(attempt.get("metadata") or {}), "duplicate_transaction_id": group["_id"]}
+            await collection.update_one({"_id": attempt["_id"]}, {"$set": {"metadata": metadata}, "$unset": {"transaction_id": ""}})
+            moved += 1
+    if moved:
+        logger.warning("Moved %d duplicate payment attempt transaction ids to metadata.duplicate_transaction_id", moved)
+    return moved
+
+async def dedupe_subscriptions_per_user(database: AsyncIOMotorDatabase) -> int:
+    # Keeps each user's most recently updated subscription and moves the rest, unchanged, to
+    # DUPLICATE_SUBSCRIPTIONS_COLLECTION so nothing is lost.
+    collection = database[Subscription.Settings.name]
+    if await _has_unique_index(collection, "user.$id"):
+        return 0
+    seen_users = set()
+    duplicate_ids = []
+    async for subscription in collection.find({}, {"user": 1}).sort("updated_at", -1):
+        user_id = subscription["user"].id
+        if user_id in seen_users:
+            duplicate_ids.append(subscription["_id"])
+        else:
+            seen_users.add(user_id)
+    if duplicate_ids:
+        duplicates = await collection.find({"_id": {"$in": duplicate_ids}}).to_list(length=None)
+        await database[DUPLICATE_SUBSCRIPTIONS_COLLECTION].insert_many(duplicates)
+        await collection.delete_many({"_id": {"$in": duplicate_ids}})
+        logger.warning("Moved %d duplicate subscriptions to %s", len(duplicate_ids), DUPLICATE_SUBSCRIPTIONS_COLLECTION)
+    return len(duplicate_ids)
+
+async def prepare_unique_indexes(database: AsyncIOMotorDatabase):
+    await dedupe_payment_attempt_transaction_ids(database)
+    await dedupe_subscriptions_per_user(database)
\ No newline at end of file
@@ -3,15 +3,19 @@ from beanie import init_beanie
 from app.core.config import settings
 from app.models.user import User
 from app.models.payment import PaymentAttempt, Subscription
+from app.db.migrations import prepare_unique_indexes
 
 client: AsyncIOMotorClient = None
 
 async def connect_to_mongo():
     global client
     print("Connecting to MongoDB...")
-    client = AsyncIOMotorClient(str(settings.DATABASE_URL))
+    # Beanie stores UUIDs as standard (subtype 4) binary; raw motor writes need to match
+    client = AsyncIOMotorClient(str(settings.DATABASE_URL), uuidRepresentation="standard")
+    database = client[settings.DATABASE_NAME]
+    await prepare_unique_indexes(database) # Older data may hold duplicates the unique indexes reject
     await init_beanie(
-        database=client[settings.DATABASE_NAME],
+        database=database,
         document_models=[
             User,
             PaymentAttempt,
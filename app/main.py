@@ -1,11 +1,14 @@
 from fastapi import FastAPI, Request, status
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
 
 from app.core.config import settings
 from app.db.mongodb_utils import connect_to_mongo, close_mongo_connection
+from app.core.http_clients import open_paystack_client, close_paystack_client
+from app.services.counter_batcher import counter_batcher
 from app.api.v1.router import api_router_v1
 from app.utils.exceptions import AppExceptionBase, APIError
 
@@ -13,13 +16,18 @@ from app.utils.exceptions import AppExceptionBase, APIError
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await connect_to_mongo()
+    await open_paystack_client()
+    counter_batcher.start()
     yield
+    await counter_batcher.stop()
+    await close_paystack_client()
     await close_mongo_connection()
 
 app = FastAPI(
     title=settings.PROJECT_NAME,
     version=settings.PROJECT_VERSION,
     openapi_url=f"{settings.API_V1_STR}/openapi.json" if settings.DEBUG else None,
+    default_response_class=ORJSONResponse,
     lifespan=lifespan
 )
 
@@ -33,21 +41,22 @@ app.add_middleware(
 
 @app.exception_handler(AppExceptionBase)
 async def app_exception_handler(request: Request, exc: AppExceptionBase):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=exc.status_code,
         content={"detail": exc.detail, "error_code": exc.error_code},
+        headers=exc.headers,
     )
 
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
         content={"detail": exc.errors(), "error_code": "VALIDATION_ERROR"},
     )
 
 @app.exception_handler(Exception)
 async def generic_exception_handler(request: Request, exc: Exception):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
         content={"detail": "An unexpected internal server error occurred.", "error_code": "INTERNAL_SERVER_ERROR"} if settings.DEBUG else {"detail": "Internal Server Error"},
     )
@@ -64,7 +73,7 @@ if settings.DEBUG:
     async def debug_config():
         return {
             "project_name": settings.PROJECT_NAME,
-            "database_url_partial": str(settings.DATABASE_URL.with_path("")),
+            "database_url_partial": urlsplit(settings.DATABASE_URL)._replace(path="").geturl(),
             "database_name": settings.DATABASE_NAME,
             "google_client_id_set": bool(settings.GOOGLE_CLIENT_ID),
             "usdt_wallet_set": bool(settings.USDT_ETH_WALLET_ADDRESS),
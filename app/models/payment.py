@@ -2,6 +2,7 @@ from beanie import Document, Link
 from pydantic import Field
 from typing import Optional, Literal
 from datetime import datetime
+from pymongo import ASCENDING, IndexModel
 import uuid
 from app.models.user import User
 
@@ -20,6 +21,14 @@ class PaymentAttempt(Document):
 
     class Settings:
         name = "payment_attempts"
+        indexes = [
+            # Paystack references and USDT hashes are unique; the partial filter skips attempts without one yet
+            IndexModel(
+                [("transaction_id", ASCENDING)],
+                unique=True,
+                partialFilterExpression={"transaction_id": {"$type": "string"}},
+            ),
+        ]
 
     async def before_save(self):
         self.updated_at = datetime.utcnow()
@@ -38,6 +47,9 @@ class Subscription(Document):
     
     class Settings:
         name = "subscriptions"
+        indexes = [
+            IndexModel([("user.$id", ASCENDING)], unique=True), # One subscription document per user
+        ]
 
     async def before_save(self):
         self.updated_at = datetime.utcnow()
\ No newline at end of file
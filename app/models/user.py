@@ -1,6 +1,7 @@
 from typing import Optional, Literal, Annotated
 from beanie import Document, Indexed # Indexed might be unused if all fields are changed
-from pydantic import EmailStr, Field
+from pydantic import BaseModel, EmailStr, Field
+from pymongo import ASCENDING, IndexModel
 import uuid
 from datetime import datetime
 
@@ -30,9 +31,33 @@ class User(Document):
     monthly_requests_used: int = 0 # Resets monthly for "monthly" subscribers
     last_request_date: Optional[datetime] = None
 
+    # Denormalized access state, recomputed by user_repo.refresh_access_state whenever the
+    # subscription or usage counters change. A None tier means it has not been computed yet.
+    effective_tier: Optional[Literal["free", "monthly", "one_time", "expired"]] = None
+    requests_remaining: Optional[int] = None # None with a computed tier means unlimited (one-time)
+    # Id of the last counter_batcher flush applied to this document, so a reload can tell
+    # whether it already includes the batch that is being written
+    counter_batch_id: Optional[uuid.UUID] = None
+
     class Settings:
         name = "users"
         keep_nulls = False # Important for sparse indexes like google_id
+        # Field(unique=True) is only schema metadata, Beanie builds indexes from this list
+        indexes = [
+            IndexModel([("email", ASCENDING)], unique=True),
+            IndexModel([("google_id", ASCENDING)], unique=True, sparse=True),
+            # Subscription lifecycle scans, e.g. finding lapsed monthly subscriptions
+            IndexModel([("subscription_type", ASCENDING), ("subscription_end_date", ASCENDING)]),
+        ]
 
     async def before_save(self):
-        self.updated_at = datetime.utcnow()
\ No newline at end of file
+        self.updated_at = datetime.utcnow()
+
+class UserAuthView(BaseModel):
+    # Projection for the email login path, which only needs to check the password and status
+    id: uuid.UUID
+    hashed_password: Optional[str] = None
+    is_active: bool = True
+
+    class Settings:
+        projection = {"id": "$_id", "hashed_password": 1, "is_active": 1}
\ No newline at end of file
@@ -1,11 +1,14 @@
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
+from beanie import UpdateResponse
+from pymongo.errors import DuplicateKeyError
 
 from app.models.user import User
+from app.repositories.user import refresh_access_state, access_state_pipeline
 from app.models.payment import PaymentAttempt, Subscription
 from app.schemas.payment_schemas import CreateUSDTTransactionRequest
 from app.core.config import settings
-from typing import Optional, Literal, Union
+from typing import Iterable, Optional, Literal, Union
 
 async def create_payment_attempt(
     user: User,
@@ -33,65 +36,171 @@ async def create_payment_attempt(
 async def get_payment_attempt(payment_attempt_id: uuid.UUID) -> Optional[PaymentAttempt]:
     return await PaymentAttempt.get(payment_attempt_id)
 
+async def get_payment_attempt_by_reference(reference: str, payment_processor: str) -> Optional[PaymentAttempt]:
+    # Served by the unique transaction_id index; payment_processor is checked on the matched document
+    return await PaymentAttempt.find_one(
+        PaymentAttempt.transaction_id == reference,
+        PaymentAttempt.payment_processor == payment_processor
+    )
+
+async def get_or_create_payment_attempt_by_reference(
+    user: User,
+    reference: str,
+    payment_processor: str,
+    amount: float,
+    currency: str,
+    metadata: Optional[dict] = None,
+) -> PaymentAttempt:
+    # Stores the pending card attempt for a processor reference that has none yet. transaction_id is
+    # unique, so a concurrent insert for the same reference returns the stored attempt instead.
+    try:
+        return await create_payment_attempt(
+            user=user,
+            amount=amount,
+            currency=currency,
+            payment_method="card",
+            payment_processor=payment_processor,
+            transaction_id=reference,
+            metadata=metadata,
+        )
+    except DuplicateKeyError:
+        return await get_payment_attempt_by_reference(reference, payment_processor)
+
 async def update_payment_attempt_status(
     payment_attempt: PaymentAttempt,
-    status: Literal["pending", "succeeded", "failed", "requires_action"],
+    status: Literal["pending", "succeeded", "failed", "requires_action", "abandoned"],
     transaction_id: Optional[str] = None,
     metadata: Optional[dict] = None,
 ) -> PaymentAttempt:
-    payment_attempt.status = status
+    fields = {"status": status, "updated_at": datetime.utcnow()}
     if transaction_id:
-        payment_attempt.transaction_id = transaction_id
+        fields["transaction_id"] = transaction_id
     if metadata:
-        payment_attempt.metadata = metadata if payment_attempt.metadata is None else {**payment_attempt.metadata, **metadata}
-    await payment_attempt.save()
-    return payment_attempt
+        fields["metadata"] = metadata if payment_attempt.metadata is None else {**payment_attempt.metadata, **metadata}
+    # Targeted $set returning the fresh document, guarded so a late failure from one verifier
+    # cannot demote an attempt that another verifier (or the webhook) already settled.
+    updated = await PaymentAttempt.find_one({"_id": payment_attempt.id, "status": {"$ne": "succeeded"}}).update(
+        {"$set": fields}, response_type=UpdateResponse.NEW_DOCUMENT
+    )
+    return updated or payment_attempt
+
+async def mark_payment_attempt_succeeded(payment_attempt: PaymentAttempt, transaction_id: Optional[str] = None) -> bool:
+    # Single atomic find-and-update guarded on status, so concurrent verifications (client retry,
+    # another worker) cannot both transition the attempt and activate the subscription twice.
+    fields = {"status": "succeeded", "updated_at": datetime.utcnow()}
+    if transaction_id:
+        fields["transaction_id"] = transaction_id
+    updated = await PaymentAttempt.find_one({"_id": payment_attempt.id, "status": {"$ne": "succeeded"}}).update(
+        {"$set": fields}, response_type=UpdateResponse.NEW_DOCUMENT
+    )
+    if updated is None:
+        return False
+    payment_attempt.status = "succeeded"
+    if transaction_id:
+        payment_attempt.transaction_id = transaction_id
+    return True
 
 
-async def create_or_update_subscription(
+async def claim_payment_attempt(
+    payment_attempt_id: uuid.UUID,
+    user_id: uuid.UUID,
+    transaction_id: str,
+    payment_types: Iterable[str],
+) -> Optional[PaymentAttempt]:
+    # Ownership, non-terminal status and a known payment type are all enforced by the filter, so the
+    # confirmation is one round trip and a concurrent confirm/fail can't slip in between check and write.
+    # Returns None when any condition fails; callers read the attempt again to find out which one.
+    return await PaymentAttempt.find_one({
+        "_id": payment_attempt_id,
+        "user.$id": user_id,
+        "status": {"$nin": ["succeeded", "failed"]},
+        "metadata.payment_type": {"$in": list(payment_types)},
+    }).update(
+        {"$set": {"transaction_id": transaction_id, "status": "succeeded", "updated_at": datetime.utcnow()}},
+        response_type=UpdateResponse.NEW_DOCUMENT,
+    )
+
+
+async def release_payment_attempt_claim(payment_attempt: PaymentAttempt) -> None:
+    # Undoes a claim whose subscription could not be written, so a retried confirmation, verification
+    # or webhook can claim the attempt again instead of finding it already succeeded.
+    await PaymentAttempt.find_one({"_id": payment_attempt.id, "status": "succeeded"}).update(
+        {"$set": {"status": "pending", "updated_at": datetime.utcnow()}}
+    )
+    payment_attempt.status = "pending"
+
+
+def apply_subscription_to_user(
     user: User,
     subscription_type: Literal["monthly", "one_time"],
-    payment_processor_subscription_id: Optional[str] = None, # For Stripe
-    status: Literal["active", "inactive", "cancelled", "past_due"] = "active",
-    start_date: datetime = datetime.utcnow(),
-    end_date: Optional[datetime] = None, # Calculated based on type
-) -> Subscription:
-    
-    existing_subscription = await Subscription.find_one(Subscription.user.id == user.id)
-
+    start_date: datetime,
+) -> Optional[datetime]:
+    # In-memory only: lets callers answer from the new subscription state before it is persisted
     if subscription_type == "monthly":
         end_date = start_date + timedelta(days=30) # Simple 30 day cycle
-    elif subscription_type == "one_time":
-        end_date = None # Or a very far future date if preferred
-
-    if existing_subscription:
-        subscription = existing_subscription
-        subscription.subscription_type = subscription_type
-        subscription.payment_processor_subscription_id = payment_processor_subscription_id if payment_processor_subscription_id else subscription.payment_processor_subscription_id
-        subscription.status = status
-        subscription.start_date = start_date
-        subscription.end_date = end_date
-        subscription.last_payment_date = start_date
     else:
-        subscription = Subscription(
-            user=user.to_ref(),
-            subscription_type=subscription_type,
-            payment_processor_subscription_id=payment_processor_subscription_id,
-            status=status,
-            start_date=start_date,
-            end_date=end_date,
-            last_payment_date=start_date
-        )
-    
-    await subscription.save()
+        end_date = None # Or a very far future date if preferred
 
     user.subscription_type = subscription_type
-    user.subscription_id = str(subscription.id)
     user.subscription_start_date = start_date
     user.subscription_end_date = end_date
     if subscription_type == "monthly": # Reset monthly count on new/updated monthly sub
         user.monthly_requests_used = 0
-    await user.save()
+    refresh_access_state(user)
+    return end_date
+
+async def create_or_update_subscription(
+    user: User,
+    subscription_type: Literal["monthly", "one_time"],
+    payment_processor_subscription_id: Optional[str] = None, # For Stripe
+    status: Literal["active", "inactive", "cancelled", "past_due"] = "active",
+    start_date: Optional[datetime] = None,
+) -> Subscription:
+    
+    start_date = start_date or datetime.utcnow()
+    end_date = apply_subscription_to_user(user, subscription_type, start_date)
+    fields = {
+        "subscription_type": subscription_type,
+        "status": status,
+        "start_date": start_date,
+        "end_date": end_date,
+        "last_payment_date": start_date,
+    }
+    if payment_processor_subscription_id:
+        fields["payment_processor_subscription_id"] = payment_processor_subscription_id
+
+    subscription = await Subscription.find_one(Subscription.user.id == user.id)
+    inserted = False
+    if subscription is None:
+        try:
+            subscription = await Subscription(user=user.to_ref(), **fields).insert()
+            inserted = True
+        except DuplicateKeyError:
+            # A concurrent activation inserted this user's subscription first (unique on user.$id);
+            # apply ours on top of it instead of failing or creating a second document.
+            subscription = await Subscription.find_one(Subscription.user.id == user.id)
+
+    if not inserted:
+        for field, value in fields.items():
+            setattr(subscription, field, value)
+        await subscription.save()
+
+    user.subscription_id = str(subscription.id)
+    # Only the subscription fields are written; a full save would also overwrite the usage counters
+    # with this instance's values while other workers are incrementing them.
+    now = datetime.utcnow()
+    user_fields = {
+        "subscription_type": subscription_type,
+        "subscription_id": user.subscription_id,
+        "subscription_start_date": start_date,
+        "updated_at": now,
+    }
+    if subscription_type == "monthly":
+        user_fields["monthly_requests_used"] = 0
+    user_fields["subscription_end_date"] = end_date if end_date is not None else "$$REMOVE"
+    await User.get_motor_collection().update_one(
+        {"_id": user.id}, [{"$set": user_fields}, *access_state_pipeline(now)]
+    )
     
     return subscription
 
@@ -1,64 +1,110 @@
-from typing import Optional, Union
+from typing import Any, Dict, List, Optional
+import asyncio
 import uuid
 from beanie.exceptions import DocumentNotFound
-from datetime import datetime
+from datetime import datetime, timezone
 
-from app.models.user import User
-from app.schemas.user_schemas import UserCreate, UserCreateGoogle, UserUpdate
+from app.models.user import User, UserAuthView
+from app.schemas.user_schemas import UserCreate, UserCreateGoogle
 from app.core.security import get_password_hash
+from app.core.config import settings
+from app.utils.clock import cached_utcnow
+
+def refresh_access_state(user: User, now: Optional[datetime] = None) -> None:
+    # Recomputes effective_tier/requests_remaining in memory; callers persist them with their own write.
+    now = now or cached_utcnow()
+    end_date = user.subscription_end_date
+    if end_date is not None and end_date.tzinfo is not None: # Stored naive, but accept aware values
+        end_date = end_date.astimezone(timezone.utc).replace(tzinfo=None)
+
+    if user.subscription_type == "one_time":
+        user.effective_tier = "one_time"
+        user.requests_remaining = None
+    elif user.subscription_type == "monthly" and end_date is not None and end_date > now:
+        user.effective_tier = "monthly"
+        user.requests_remaining = max(0, settings.MONTHLY_REQUEST_LIMIT - user.monthly_requests_used)
+    else: # Never subscribed or lapsed monthly subscription, both fall back to the free tier allowance
+        user.effective_tier = "expired" if user.subscription_type == "monthly" else "free"
+        user.requests_remaining = max(0, settings.FREE_REQUEST_LIMIT - user.free_requests_used)
+
+def access_state_pipeline(now: datetime) -> List[Dict[str, Any]]:
+    # Server-side twin of refresh_access_state for pipeline updates. Derives effective_tier and
+    # requests_remaining from the stored subscription and counters, so a write never replaces
+    # them with one worker's in-memory view while other workers are incrementing the counters.
+    return [
+        {"$set": {"effective_tier": {"$switch": {
+            "branches": [
+                {"case": {"$eq": ["$subscription_type", "one_time"]}, "then": "one_time"},
+                {"case": {"$and": [
+                    {"$eq": ["$subscription_type", "monthly"]},
+                    {"$gt": ["$subscription_end_date", now]},
+                ]}, "then": "monthly"},
+                {"case": {"$eq": ["$subscription_type", "monthly"]}, "then": "expired"},
+            ],
+            "default": "free",
+        }}}},
+        {"$set": {"requests_remaining": {"$switch": {
+            "branches": [
+                {"case": {"$eq": ["$effective_tier", "one_time"]}, "then": "$$REMOVE"}, # keep_nulls=False
+                {"case": {"$eq": ["$effective_tier", "monthly"]}, "then": {"$max": [
+                    0, {"$subtract": [settings.MONTHLY_REQUEST_LIMIT, {"$ifNull": ["$monthly_requests_used", 0]}]}
+                ]}},
+            ],
+            "default": {"$max": [0, {"$subtract": [settings.FREE_REQUEST_LIMIT, {"$ifNull": ["$free_requests_used", 0]}]}]},
+        }}}},
+    ]
 
 async def get_user_by_email(email: str) -> Optional[User]:
     return await User.find_one(User.email == email)
 
-async def get_user_by_id(user_id: Union[str, uuid.UUID]) -> Optional[User]:
-    if isinstance(user_id, str):
-        try:
-            user_id = uuid.UUID(user_id)
-        except ValueError:
-            return None # Invalid UUID format
+async def get_user_auth_view_by_email(email: str) -> Optional[UserAuthView]:
+    return await User.find_one(User.email == email, projection_model=UserAuthView)
+
+async def set_user_password_hash(user_id: uuid.UUID, hashed_password: str):
+    await User.find_one(User.id == user_id).update({
+        "$set": {"hashed_password": hashed_password, "updated_at": datetime.utcnow()}
+    })
+
+async def get_user_by_id(user_id: uuid.UUID) -> Optional[User]:
+    # Callers pass TokenPayload.sub, which pydantic already parsed into a UUID at decode time
     return await User.get(user_id)
     
-async def get_user_by_google_id(google_id: str) -> Optional[User]:
-    return await User.find_one(User.google_id == google_id)
+async def get_user_by_google_id_or_email(google_id: str, email: str) -> Optional[User]:
+    # Single round trip for the Google callback. Both fields are indexed, so the $or can use
+    # each index. A Google ID match wins when the two clauses hit different documents.
+    users = await User.find({"$or": [{"google_id": google_id}, {"email": email.lower()}]}).limit(2).to_list()
+    for user in users:
+        if user.google_id == google_id:
+            return user
+    return users[0] if users else None
 
 async def create_user(user_in: UserCreate) -> User:
-    hashed_password = get_password_hash(user_in.password)
+    hashed_password = await asyncio.to_thread(get_password_hash, user_in.password)
     user = User(
-        email=user_in.email.lower(),
+        email=user_in.email,
         hashed_password=hashed_password,
         full_name=user_in.full_name,
     )
+    refresh_access_state(user)
     await user.insert()
     return user
 
 async def create_user_google(user_in: UserCreateGoogle) -> User:
     user = User(
-        email=user_in.email.lower(),
+        email=user_in.email,
         google_id=user_in.google_id,
         full_name=user_in.full_name,
         is_active=True # Assuming Google verified email
     )
+    refresh_access_state(user)
     await user.insert()
     return user
     
-async def update_user(user: User, user_in: UserUpdate) -> User:
-    if user_in.email:
-        user.email = user_in.email.lower()
-    if user_in.full_name:
-        user.full_name = user_in.full_name
-    if user_in.password:
-        user.hashed_password = get_password_hash(user_in.password)
-    await user.save()
-    return user
-
-async def increment_user_request_count(user: User, is_free_request: bool):
-    if is_free_request:
-        user.free_requests_used += 1
-    else: # Paid request (monthly)
-        user.monthly_requests_used += 1
-    user.last_request_date = datetime.utcnow()
-    await user.save()
-
-async def reset_monthly_user_request_count(user: User):
-    user.monthly_requests_used = 0
-    await user.save()
\ No newline at end of file
+async def mark_free_tier_used(user: User):
+    # Filtered on "none" so it can never overwrite a subscription activated concurrently
+    now = datetime.utcnow()
+    await User.find_one({"_id": user.id, "subscription_type": "none"}).update({
+        "$set": {"subscription_type": "free_tier_used", "updated_at": now}
+    })
+    user.subscription_type = "free_tier_used"
+    user.updated_at = now
\ No newline at end of file
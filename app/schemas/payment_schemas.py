@@ -1,22 +1,26 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Literal, Optional
+import msgspec
 import uuid
 
-class CreateCardPaymentRequest(BaseModel): # Renamed from CreateCheckoutSessionRequest for clarity
+# Request bodies are msgspec Structs decoded by app.core.dependencies.msgspec_body,
+# which skips pydantic validation on these hot POST endpoints.
+class CreateCardPaymentRequest(msgspec.Struct, frozen=True): # Renamed from CreateCheckoutSessionRequest for clarity
     payment_type: Literal["one_time", "monthly"]
 
 # Renamed from StripeCheckoutSessionResponse
-class PaystackInitializationResponse(BaseModel):
+class PaystackInitializationResponse(msgspec.Struct, frozen=True): # Response-only, serialized by MsgspecResponse
     authorization_url: str
     access_code: str
     reference: str
     publishable_key: Optional[str] = None # Paystack public key, send if frontend needs it (e.g. for Paystack JS)
 
-class CreateUSDTTransactionRequest(BaseModel):
+class CreateUSDTTransactionRequest(msgspec.Struct, frozen=True):
     payment_type: Literal["one_time", "monthly"]
     # Removed transaction_hash from here, as it's for confirmation step
 
 class USDTTransactionResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
     message: str
     payment_attempt_id: uuid.UUID
     wallet_address: str
@@ -24,6 +28,7 @@ class USDTTransactionResponse(BaseModel):
     payment_type: Literal["one_time", "monthly"]
 
 class PaymentStatusResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
     user_id: uuid.UUID
     subscription_type: str
     is_active_subscriber: bool
@@ -1,13 +1,15 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from typing import Optional
+import msgspec
 import uuid
 
-class Token(BaseModel):
+class Token(msgspec.Struct, frozen=True): # Response-only, serialized by MsgspecResponse
     access_token: str
     refresh_token: str
     token_type: str
 
 class TokenPayload(BaseModel):
+    model_config = ConfigDict(frozen=True) # Shared through the token cache, never mutated
     sub: Optional[uuid.UUID] = None
     type: Optional[str] = None # "access" or "refresh"
     exp: Optional[int] = None
\ No newline at end of file
@@ -1,4 +1,4 @@
-from pydantic import BaseModel, EmailStr, Field, field_validator
+from pydantic import BaseModel, ConfigDict, EmailStr, Field, field_validator
 from typing import Optional
 import uuid
 from datetime import datetime
@@ -7,6 +7,12 @@ class UserBase(BaseModel):
     email: EmailStr
     full_name: Optional[str] = None
 
+    # Emails are stored lowercased, normalize once at parse time
+    @field_validator("email")
+    @classmethod
+    def normalize_email(cls, v: str) -> str:
+        return v.lower()
+
 class UserCreate(UserBase):
     password: str = Field(min_length=8)
 
@@ -18,6 +24,11 @@ class UserUpdate(BaseModel):
     full_name: Optional[str] = None
     password: Optional[str] = Field(default=None, min_length=8)
 
+    @field_validator("email")
+    @classmethod
+    def normalize_email(cls, v: Optional[str]) -> Optional[str]:
+        return v.lower() if v else v
+
 class UserResponse(UserBase):
     id: uuid.UUID
     is_active: bool
@@ -29,8 +40,7 @@ class UserResponse(UserBase):
     created_at: datetime
     updated_at: datetime
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True, frozen=True)
 
 class UserLogin(BaseModel):
     email: EmailStr
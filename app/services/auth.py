@@ -1,25 +1,33 @@
 from fastapi import HTTPException, status, Request, Response
 from fastapi.security import OAuth2PasswordRequestForm
-from google_auth_oauthlib.flow import Flow # Replaced httpx_oauth.google
-from google.oauth2 import id_token # For verifying Google ID token
-from google.auth.transport.requests import Request as GoogleAuthRequest # For verifying Google ID token
 
 from typing import Optional
+from datetime import datetime
+import asyncio
+from functools import lru_cache
+from cachetools import TTLCache
 import json # For loading client secrets if stored as JSON
 
 from app.core.config import settings
-from app.core.security import create_access_token, create_refresh_token, verify_password
+from app.core.security import create_token_pair, verify_and_update_password
 from app.repositories import user as user_repo
+from app.services.user import user_to_response
 from app.schemas.user_schemas import UserCreate, UserCreateGoogle, UserResponse
-from app.schemas.token_schemas import Token
+from app.schemas.token_schemas import Token, TokenPayload
 from app.models.user import User
 from app.utils.exceptions import AuthError, DuplicateResourceError, AppLogicError
 
 # google_oauth_client = None # Replaced by flow object initialization
 
 # --- Start of new Google OAuth setup using google-auth-oauthlib ---
-google_flow = None
-if settings.GOOGLE_CLIENT_ID and settings.GOOGLE_CLIENT_SECRET:
+_GOOGLE_SCOPES = ['openid', 'https://www.googleapis.com/auth/userinfo.email', 'https://www.googleapis.com/auth/userinfo.profile']
+
+# Only a successfully built config is cached; a misconfiguration raises and is retried on the next call.
+@lru_cache(maxsize=1)
+def _get_google_client_config() -> dict:
+    if not (settings.GOOGLE_CLIENT_ID and settings.GOOGLE_CLIENT_SECRET):
+        raise AppLogicError(detail="Google OAuth not configured", error_code="GOOGLE_OAUTH_NOT_CONFIGURED")
+
     # Option 1: If you have client_secret.json file (recommended by Google)
     # try:
     #     google_flow = Flow.from_client_secrets_file(
@@ -37,7 +45,7 @@ if settings.GOOGLE_CLIENT_ID and settings.GOOGLE_CLIENT_SECRET:
     # However, we can adapt it if GOOGLE_CLIENT_SECRET is the actual secret string
     # and not a path to a file.
     # If GOOGLE_CLIENT_SECRET is the secret string itself:
-    client_config = {
+    return {
         "web": {
             "client_id": settings.GOOGLE_CLIENT_ID,
             "client_secret": settings.GOOGLE_CLIENT_SECRET,
@@ -48,19 +56,67 @@ if settings.GOOGLE_CLIENT_ID and settings.GOOGLE_CLIENT_SECRET:
             # "javascript_origins": ["http://localhost:3000"] # Optional: for client-side apps
         }
     }
+
+def _get_google_flow():
+    # A new Flow per request, built from the cached config: a Flow stores the fetched token on
+    # itself, so a shared one would let concurrent callbacks read each other's credentials.
+    # google-auth-oauthlib is slow to import, so it is imported on first use rather than at import.
+    client_config = _get_google_client_config()
+    from google_auth_oauthlib.flow import Flow # Replaced httpx_oauth.google
+
     try:
-        google_flow = Flow.from_client_config(
+        return Flow.from_client_config(
             client_config,
-            scopes=['openid', 'https://www.googleapis.com/auth/userinfo.email', 'https://www.googleapis.com/auth/userinfo.profile'],
+            scopes=_GOOGLE_SCOPES,
             redirect_uri=str(settings.GOOGLE_REDIRECT_URI)
         )
     except Exception as e:
         # Handle potential errors during Flow initialization if config is malformed
-        # For simplicity, we'll just print an error or log it
         print(f"Error initializing Google OAuth Flow: {e}")
-        google_flow = None
+        raise AppLogicError(detail="Google OAuth not configured", error_code="GOOGLE_OAUTH_NOT_CONFIGURED")
 # --- End of new Google OAuth setup ---
 
+# Google's ID-token signing certs rotate roughly weekly, and new keys are published before use.
+_GOOGLE_CERTS_URLS = frozenset({
+    "https://www.googleapis.com/oauth2/v1/certs",
+    "https://www.googleapis.com/oauth2/v3/certs",
+})
+_google_certs_cache: TTLCache = TTLCache(maxsize=4, ttl=3600)
+_google_auth_request = None
+
+class _CachingGoogleAuthRequest:
+    # google.auth transport wrapper that serves repeat GETs of Google's certs from memory,
+    # so verify_oauth2_token does not download them on every login.
+    def __init__(self, transport):
+        self._transport = transport
+
+    def __call__(self, url, method="GET", **kwargs):
+        is_certs_fetch = method == "GET" and url in _GOOGLE_CERTS_URLS
+        if is_certs_fetch and url in _google_certs_cache:
+            return _google_certs_cache[url]
+        response = self._transport(url, method=method, **kwargs)
+        if is_certs_fetch and response.status == 200:
+            _google_certs_cache[url] = response
+        return response
+
+def _get_google_auth_request() -> _CachingGoogleAuthRequest:
+    # One pooled requests.Session for all callbacks instead of a new session and TLS handshake per login
+    global _google_auth_request
+    if _google_auth_request is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from google.auth.transport.requests import Request as GoogleAuthRequest
+
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=10))
+        _google_auth_request = _CachingGoogleAuthRequest(GoogleAuthRequest(session=session))
+    return _google_auth_request
+
+def _exchange_google_code(google_flow, code: str) -> str:
+    google_flow.fetch_token(code=code) # For server-side flow with code
+    return google_flow.credentials.id_token
+
+
 
 async def register_user_email_password(user_in: UserCreate) -> UserResponse:
     existing_user = await user_repo.get_user_by_email(email=user_in.email)
@@ -68,25 +124,29 @@ async def register_user_email_password(user_in: UserCreate) -> UserResponse:
         raise DuplicateResourceError(detail="User with this email already exists", error_code="EMAIL_EXISTS")
     
     user = await user_repo.create_user(user_in=user_in)
-    return UserResponse.model_validate(user)
+    return user_to_response(user)
 
 async def login_email_password(form_data: OAuth2PasswordRequestForm) -> Token:
-    user = await user_repo.get_user_by_email(email=form_data.username)
+    user = await user_repo.get_user_auth_view_by_email(email=form_data.username)
     if not user or not user.hashed_password: # No password for OAuth users initially
         raise AuthError(detail="Incorrect email or password (user may have registered with Google)", error_code="LOGIN_INVALID_CREDENTIALS")
     
-    if not verify_password(form_data.password, user.hashed_password):
+    # Password hashing is CPU-bound, so keep it off the event loop thread
+    verified, new_hashed_password = await asyncio.to_thread(verify_and_update_password, form_data.password, user.hashed_password)
+    if not verified:
         raise AuthError(detail="Incorrect email or password", error_code="LOGIN_INVALID_CREDENTIALS")
     
     if not user.is_active:
         raise AuthError(detail="Inactive user", error_code="INACTIVE_USER")
 
-    access_token = create_access_token(subject=user.id)
-    refresh_token = create_refresh_token(subject=user.id)
+    if new_hashed_password: # Transparent upgrade of legacy bcrypt hashes
+        await user_repo.set_user_password_hash(user.id, new_hashed_password)
+
+    access_token, refresh_token = create_token_pair(user.id)
     return Token(access_token=access_token, refresh_token=refresh_token, token_type="bearer")
 
-async def refresh_access_token(refresh_token_payload: dict) -> Token:
-    user_id = refresh_token_payload.get("sub")
+async def refresh_access_token(refresh_token_payload: TokenPayload) -> Token:
+    user_id = refresh_token_payload.sub
     if not user_id:
         raise AuthError(detail="Invalid refresh token", error_code="INVALID_REFRESH_TOKEN")
     
@@ -94,15 +154,13 @@ async def refresh_access_token(refresh_token_payload: dict) -> Token:
     if not user or not user.is_active:
         raise AuthError(detail="User not found or inactive", error_code="USER_NOT_FOUND_OR_INACTIVE")
 
-    new_access_token = create_access_token(subject=user.id)
-    new_refresh_token = create_refresh_token(subject=user.id) 
+    new_access_token, new_refresh_token = create_token_pair(user.id)
     
     return Token(access_token=new_access_token, refresh_token=new_refresh_token, token_type="bearer")
 
 
 async def get_google_oauth_authorize_url(request: Request) -> str: # Request might not be needed if state is handled differently
-    if not google_flow:
-        raise AppLogicError(detail="Google OAuth not configured", error_code="GOOGLE_OAUTH_NOT_CONFIGURED")
+    google_flow = _get_google_flow()
     
     # The 'state' parameter is recommended for preventing CSRF attacks.
     # You might want to generate and store it in the session or a temporary cache.
@@ -118,8 +176,7 @@ async def get_google_oauth_authorize_url(request: Request) -> str: # Request mig
 
 
 async def handle_google_oauth_callback(request: Request, code: str) -> Token: # `request` is needed to reconstruct the full callback URL
-    if not google_flow:
-        raise AppLogicError(detail="Google OAuth not configured", error_code="GOOGLE_OAUTH_NOT_CONFIGURED")
+    google_flow = _get_google_flow()
 
     # It's important that the redirect_uri used here is *exactly* the same as the one
     # used to generate the authorization URL and configured in Google Cloud Console.
@@ -131,22 +188,23 @@ async def handle_google_oauth_callback(request: Request, code: str) -> Token: #
     # if not stored_state or stored_state != received_state:
     #     raise AuthError(detail="OAuth state mismatch, possible CSRF attack.", error_code="GOOGLE_OAUTH_STATE_MISMATCH")
 
+    from google.oauth2 import id_token # For verifying Google ID token
+
     try:
         # Reconstruct the full callback URL that Google redirected to.
         # This is sometimes required by the OAuth library.
         full_callback_url = str(request.url)
         
-        # Exchange the authorization code for an access token and ID token
-        google_flow.fetch_token(code=code) # For server-side flow with code
+        # Exchange the authorization code for an access token and ID token.
+        # Both steps do blocking HTTP (token endpoint, certs fetch), so they run in worker threads.
+        google_id_token = await asyncio.to_thread(_exchange_google_code, google_flow, code)
         # Or if you are passing the full authorization response URL:
         # google_flow.fetch_token(authorization_response=full_callback_url)
 
-        credentials = google_flow.credentials
-        
         # Verify the ID token and get user info
         # The ID token is JWT signed by Google and contains user information.
-        id_info = id_token.verify_oauth2_token(
-            credentials.id_token, GoogleAuthRequest(), settings.GOOGLE_CLIENT_ID
+        id_info = await asyncio.to_thread(
+            id_token.verify_oauth2_token, google_id_token, _get_google_auth_request(), settings.GOOGLE_CLIENT_ID
         )
 
     except ValueError as e: # google.oauth2.id_token.verify_oauth2_token can raise ValueError
@@ -166,27 +224,22 @@ async def handle_google_oauth_callback(request: Request, code: str) -> Token: #
     # if not email_verified:
     #     raise AuthError(detail="Google email not verified", error_code="GOOGLE_EMAIL_NOT_VERIFIED")
 
-    user = await user_repo.get_user_by_google_id(google_id)
-    if not user:
-        user = await user_repo.get_user_by_email(email)
-        if user: # Existing email user, link Google ID
-            if user.google_id is None:
-                user.google_id = google_id
-                # If you store name and it might differ, update it:
-                # if full_name and user.full_name != full_name:
-                #     user.full_name = full_name
-                await user.save()
-            elif user.google_id != google_id: 
-                raise AuthError(detail="Email already associated with a different Google account.", error_code="EMAIL_GOOGLE_MISMATCH")
-        else: # New user via Google
-            user_create_google = UserCreateGoogle(email=email, google_id=google_id, full_name=full_name)
-            user = await user_repo.create_user_google(user_in=user_create_google)
-    
-    if not user.is_active:
+    user = await user_repo.get_user_by_google_id_or_email(google_id=google_id, email=email)
+    if not user: # New user via Google
+        user_create_google = UserCreateGoogle(email=email, google_id=google_id, full_name=full_name)
+        user = await user_repo.create_user_google(user_in=user_create_google)
+    elif not user.is_active: # Checked before any link write, an inactive account is never modified
         raise AuthError(detail="User account is inactive.", error_code="INACTIVE_USER_GOOGLE")
+    elif user.google_id != google_id: # Matched by email only
+        if user.google_id is None: # Existing email user, link Google ID
+            # Targeted $set of the touched fields instead of replacing the whole document
+            # If you store name and it might differ, add it here:
+            # if full_name and user.full_name != full_name: User.full_name: full_name
+            await user.set({User.google_id: google_id, User.updated_at: datetime.utcnow()})
+        else:
+            raise AuthError(detail="Email already associated with a different Google account.", error_code="EMAIL_GOOGLE_MISMATCH")
 
     # Generate your application's tokens
-    app_access_token = create_access_token(subject=user.id)
-    app_refresh_token = create_refresh_token(subject=user.id)
+    app_access_token, app_refresh_token = create_token_pair(user.id)
     
     return Token(access_token=app_access_token, refresh_token=app_refresh_token, token_type="bearer")
\ No newline at end of file
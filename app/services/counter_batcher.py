@@ -0,0 +1,157 @@
+from typing import Dict, List, Optional
+from datetime import datetime
+import asyncio
+import logging
+import uuid
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, ServerSelectionTimeoutError
+
+from app.models.user import User
+from app.repositories.user import refresh_access_state, access_state_pipeline
+from app.utils.clock import cached_utcnow
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL_SECONDS = 0.1
+FLUSH_MAX_PENDING = 50
+
+class _PendingCounts:
+    __slots__ = ("free", "monthly", "last_request_date")
+
+    def __init__(self):
+        self.free = 0
+        self.monthly = 0
+        self.last_request_date: Optional[datetime] = None
+
+    def merge(self, other: "_PendingCounts"):
+        self.free += other.free
+        self.monthly += other.monthly
+        if self.last_request_date is None or (other.last_request_date and other.last_request_date > self.last_request_date):
+            self.last_request_date = other.last_request_date
+
+class CounterBatcher:
+    # Buffers faceswap counter increments per worker and writes them as one bulk_write every
+    # FLUSH_INTERVAL_SECONDS (or sooner once FLUSH_MAX_PENDING users are waiting). The counters
+    # are applied to the in-memory user straight away, and apply_pending adds them to users
+    # loaded on this worker before they reach Mongo, so limit checks see them. Only the increments are
+    # written; the stored access state is recomputed from the stored counters by the same update.
+    def __init__(self):
+        self._pending: Dict[uuid.UUID, _PendingCounts] = {}
+        self._inflight: Dict[uuid.UUID, _PendingCounts] = {} # Batch currently being written
+        self._inflight_batch_id: Optional[uuid.UUID] = None
+        self._writing: Optional[asyncio.Future] = None
+        self._flush_requested = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, user: User, is_free_request: bool):
+        pending = self._pending.get(user.id)
+        if pending is None:
+            pending = self._pending[user.id] = _PendingCounts()
+
+        if is_free_request:
+            user.free_requests_used += 1
+            pending.free += 1
+        else: # Paid request (monthly)
+            user.monthly_requests_used += 1
+            pending.monthly += 1
+        now = cached_utcnow()
+        user.last_request_date = now
+        user.updated_at = now
+        pending.last_request_date = now
+        refresh_access_state(user, now=now)
+
+        if len(self._pending) >= FLUSH_MAX_PENDING:
+            self._flush_requested.set()
+
+    def apply_pending(self, user: User):
+        # Adds this worker's increments that Mongo may not have yet (buffered or mid-flush) to
+        # counters just reloaded from it, so a reload never hands back requests already served.
+        # A reload that already carries the in-flight batch's id has those counts applied.
+        inflight = self._inflight.get(user.id) if user.counter_batch_id != self._inflight_batch_id else None
+        for counts in (self._pending.get(user.id), inflight):
+            if counts is not None:
+                user.free_requests_used += counts.free
+                user.monthly_requests_used += counts.monthly
+
+    async def flush(self):
+        if self._writing is not None: # A cancelled flush's write is still running; let it settle first
+            await asyncio.gather(self._writing, return_exceptions=True)
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        now = cached_utcnow()
+        batch_id = uuid.uuid4()
+        user_ids = list(pending)
+        operations: List[UpdateOne] = []
+        for user_id in user_ids:
+            counts = pending[user_id]
+            operations.append(UpdateOne({"_id": user_id}, [
+                {"$set": {
+                    "free_requests_used": {"$add": [{"$ifNull": ["$free_requests_used", 0]}, counts.free]},
+                    "monthly_requests_used": {"$add": [{"$ifNull": ["$monthly_requests_used", 0]}, counts.monthly]},
+                    "last_request_date": {"$max": ["$last_request_date", counts.last_request_date]},
+                    "counter_batch_id": batch_id,
+                    "updated_at": now,
+                }},
+                *access_state_pipeline(now),
+            ]))
+        self._inflight, self._inflight_batch_id = pending, batch_id
+        # Shielded, so cancelling the flush loop (stop()) never abandons a batch mid-write: the
+        # write and its requeue handling finish on their own and the next flush waits for them.
+        self._writing = asyncio.ensure_future(self._write(operations, user_ids, pending))
+        await asyncio.shield(self._writing)
+
+    async def _write(self, operations: List[UpdateOne], user_ids: List[uuid.UUID], pending: Dict[uuid.UUID, _PendingCounts]):
+        try:
+            await User.get_motor_collection().bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # Unordered: every op without a write error was applied, so only the failed ones go back
+            failed = [user_ids[error["index"]] for error in e.details.get("writeErrors", [])]
+            self._requeue({user_id: pending[user_id] for user_id in failed})
+            raise
+        except ServerSelectionTimeoutError:
+            # No server was selected, so nothing was sent and the whole batch can be retried
+            self._requeue(pending)
+            raise
+        # Any other error may have come after the write landed (e.g. a lost reply), and retrying
+        # would count those requests twice; the batch is dropped and the flush loop logs the error.
+        finally:
+            self._inflight, self._inflight_batch_id = {}, None
+            self._writing = None
+
+    def _requeue(self, pending: Dict[uuid.UUID, _PendingCounts]):
+        for user_id, counts in pending.items():
+            newer = self._pending.get(user_id)
+            if newer is None:
+                self._pending[user_id] = counts
+            else:
+                newer.merge(counts)
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=FLUSH_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Error flushing request counters")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush() # Don't drop increments buffered since the last tick
+
+counter_batcher = CounterBatcher()
\ No newline at end of file
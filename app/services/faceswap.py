@@ -1,56 +1,64 @@
 from app.models.user import User
 from app.repositories import user as user_repo
+from app.services.counter_batcher import counter_batcher
 from app.core.config import settings
 from app.utils.exceptions import AppLogicError, PaymentRequiredError
-from datetime import datetime
+from app.utils.clock import cached_utcnow
+from typing import BinaryIO
+import asyncio
+import io
+
+async def load_image_buffer(image: BinaryIO) -> memoryview:
+    if isinstance(image, io.BytesIO):
+        return image.getbuffer()
+
+    # Starlette uploads are SpooledTemporaryFiles, in memory or spilled to disk. Either way they are
+    # read through the public file API into one preallocated buffer, off the event loop thread.
+    size = image.seek(0, io.SEEK_END)
+    image.seek(0)
+    buffer = bytearray(size)
+    await asyncio.to_thread(image.readinto, buffer)
+    return memoryview(buffer)
 
 class FaceSwapProcessor:
-    async def process_swap(self, user: User, source_image_data: bytes, target_image_data: bytes) -> bytes:
+    async def process_swap(self, user: User, source_image: BinaryIO, target_image: BinaryIO) -> bytes:
         
         # 1. Check user's payment status and request limits (already handled by dependency)
         # This is an additional check or for more granular logic if needed here.
         
-        is_free_tier_eligible = user.subscription_type == "none" and user.free_requests_used < settings.FREE_REQUEST_LIMIT
-        is_one_time_subscriber = user.subscription_type == "one_time"
-        is_monthly_subscriber_active = (
-            user.subscription_type == "monthly" and
-            user.subscription_end_date and
-            user.subscription_end_date > datetime.utcnow() and
-            user.monthly_requests_used < settings.MONTHLY_REQUEST_LIMIT
-        )
-
-        can_process = False
-        is_processing_free_request = False
+        # effective_tier/requests_remaining are precomputed on the user document (and refreshed by
+        # the access dependency when a monthly period lapses), so eligibility is a single dispatch.
+        if user.effective_tier is None:
+            user_repo.refresh_access_state(user, now=cached_utcnow())
+        has_requests_left = (user.requests_remaining or 0) > 0 # one_time is matched before this is read
 
-        if is_one_time_subscriber:
-            can_process = True
-        elif is_monthly_subscriber_active:
-            can_process = True
-        elif is_free_tier_eligible:
-            can_process = True
-            is_processing_free_request = True
-        
-        if not can_process:
-            # This should ideally be caught by the FaceSwapAccessChecker dependency,
-            # but as a safeguard:
-            if user.subscription_type == "none" or user.subscription_type == "free_tier_used":
-                 raise PaymentRequiredError(
+        match user.effective_tier:
+            case "one_time":
+                is_processing_free_request = False
+            case "monthly" if has_requests_left:
+                is_processing_free_request = False
+            case "free" | "expired" if has_requests_left:
+                is_processing_free_request = True
+            case "free":
+                # This should ideally be caught by the require_faceswap_access dependency,
+                # but as a safeguard:
+                raise PaymentRequiredError(
                     detail=f"Free request limit of {settings.FREE_REQUEST_LIMIT} reached. Please subscribe for continued use.",
                     error_code="FREE_LIMIT_REACHED_PAYMENT_REQUIRED_SERVICE"
                 )
-            elif user.subscription_type == "monthly":
-                 raise PaymentRequiredError(
+            case "monthly" | "expired":
+                raise PaymentRequiredError(
                     detail="Monthly request limit reached or subscription expired. Please check your subscription.",
                     error_code="MONTHLY_LIMIT_REACHED_OR_EXPIRED_SERVICE"
                 )
-            else: # Should not happen if logic is correct
-                 raise AppLogicError(detail="User not eligible for faceswap.", error_code="USER_NOT_ELIGIBLE_SERVICE")
+            case _: # Should not happen if logic is correct
+                raise AppLogicError(detail="User not eligible for faceswap.", error_code="USER_NOT_ELIGIBLE_SERVICE")
 
 
         # 2. Placeholder for actual faceswap logic:
         # This is where you would integrate with the `deepfakes/faceswap` library.
         # This might involve:
-        #   - Saving images to temporary files.
+        #   - Decoding the file-like uploads directly (e.g. cv2.imdecode over an mmap of source_image.fileno()).
         #   - Calling the faceswap script as a subprocess.
         #   - Using a task queue (like Celery) for long-running jobs.
         #   - Handling errors from the faceswap process.
@@ -58,21 +66,31 @@ class FaceSwapProcessor:
         print(f"User {user.email} is performing a faceswap.")
         if is_processing_free_request:
             print("This is a FREE request.")
-        elif is_monthly_subscriber_active:
+        elif user.effective_tier == "monthly":
             print("This is a MONTHLY SUBSCRIBER request.")
-        elif is_one_time_subscriber:
+        else:
             print("This is a ONE-TIME SUBSCRIBER request (unlimited).")
             
         # Simulate processing
         # result_image_data = b"simulated_faceswapped_image_content"
-        if source_image_data and target_image_data: # Basic check
-            result_image_data = b"simulated_output_" + source_image_data[:10] + b"_" + target_image_data[:10]
-        else:
-            raise AppLogicError(detail="Source or target image data missing", error_code="IMAGE_DATA_MISSING")
+        # The buffers can be handed to a decoder without copying, e.g. np.frombuffer(source_buffer, np.uint8).
+        # The views are released even when loading the other image fails.
+        source_buffer = await load_image_buffer(source_image)
+        try:
+            target_buffer = await load_image_buffer(target_image)
+            try:
+                if source_buffer.nbytes and target_buffer.nbytes: # Basic check
+                    result_image_data = b"simulated_output_" + source_buffer[:10] + b"_" + target_buffer[:10]
+                else:
+                    raise AppLogicError(detail="Source or target image data missing", error_code="IMAGE_DATA_MISSING")
+            finally:
+                target_buffer.release()
+        finally:
+            source_buffer.release()
 
 
-        # 3. Update user's request count
-        await user_repo.increment_user_request_count(user, is_free_request=is_processing_free_request)
+        # 3. Update user's request count (buffered, flushed to Mongo in batches)
+        counter_batcher.record(user, is_free_request=is_processing_free_request)
 
         return result_image_data
 
@@ -1,12 +1,21 @@
-import stripe # Keep for now in case any old Stripe logic is referenced elsewhere, though new flows won't use it
+import asyncio
+import hashlib
+import hmac
+import logging
 import httpx # For Paystack API calls
+import orjson
 import uuid as uuid_pkg # to avoid conflict with schema's uuid field
 
 from fastapi import HTTPException, status, BackgroundTasks
 from datetime import datetime, timedelta
-from typing import Literal, Any
+from typing import Literal, Any, Dict, Optional, Tuple
+from cachetools import TTLCache
+from functools import lru_cache
+from pymongo.errors import DuplicateKeyError
 
 from app.core.config import settings
+from app.core.http_clients import get_paystack_client
+from app.utils.clock import cached_utcnow
 from app.models.user import User
 from app.models.payment import PaymentAttempt
 from app.repositories import payment as payment_repo, user as user_repo
@@ -14,34 +23,56 @@ from app.schemas.payment_schemas import (
     CreateCardPaymentRequest, PaystackInitializationResponse,
     CreateUSDTTransactionRequest, USDTTransactionResponse, PaymentStatusResponse
 )
-from app.utils.exceptions import PaymentError, NotFoundError, AppLogicError, InvalidInputError
+from app.utils.exceptions import PaymentError, NotFoundError, AppLogicError, InvalidInputError, DuplicateResourceError
 
-# Stripe API Key (remains for potential other uses or legacy, but not for new card payments)
-stripe.api_key = settings.STRIPE_SECRET_KEY
+logger = logging.getLogger(__name__)
 
+# Price (in cents) and description per payment type, resolved once at import instead of per request
+_PAYMENT_PLANS: Dict[str, Tuple[int, str]] = {
+    "one_time": (settings.ONE_TIME_PAYMENT_AMOUNT_USD, "One-Time Unlimited Access"),
+    "monthly": (settings.MONTHLY_SUBSCRIPTION_AMOUNT_USD, "Monthly Subscription"),
+}
+VALID_PAYMENT_TYPES = frozenset(_PAYMENT_PLANS)
+
+@lru_cache(maxsize=8)
+def _paystack_callback_url(base_callback_url: str) -> str:
+    # Only a handful of frontend origins ever call in, so each callback URL is built once
+    return f"{base_callback_url.rstrip('/')}/paystack/callback"
+
+
+# In-flight initializations keyed by (user id, payment type). A double click or frontend retry
+# shares the first request's Paystack transaction instead of opening a second one.
+_inflight_paystack_initializations: Dict[Tuple[uuid_pkg.UUID, str], asyncio.Future] = {}
 
 async def initialize_paystack_payment(
     user: User,
     payment_type: Literal["one_time", "monthly"],
-    base_callback_url: str # Base URL for frontend callback e.g. https://frontend.com/payment
+    base_callback_url: str, # Base URL for frontend callback e.g. https://frontend.com/payment
+) -> PaystackInitializationResponse:
+    key = (user.id, payment_type)
+    initialization = _inflight_paystack_initializations.get(key)
+    if initialization is None:
+        initialization = asyncio.ensure_future(
+            _initialize_paystack_payment(user, payment_type, base_callback_url)
+        )
+        _inflight_paystack_initializations[key] = initialization
+        initialization.add_done_callback(lambda _: _inflight_paystack_initializations.pop(key, None))
+    return await asyncio.shield(initialization)
+
+async def _initialize_paystack_payment(
+    user: User,
+    payment_type: Literal["one_time", "monthly"],
+    base_callback_url: str,
 ) -> PaystackInitializationResponse:
     if not settings.PAYSTACK_SECRET_KEY:
         raise AppLogicError(detail="Paystack not configured", error_code="PAYSTACK_NOT_CONFIGURED")
 
-    amount_kobo = 0
     currency = "USD" # Paystack also supports NGN, GHS etc. Assuming USD for consistency with Stripe amounts
                      # If using NGN, ensure amounts are converted correctly.
                      # Paystack amounts are in smallest currency unit (kobo for NGN, cents for USD)
-    
-    description = ""
-
-    if payment_type == "one_time":
-        amount_kobo = settings.ONE_TIME_PAYMENT_AMOUNT_USD
-        description = "One-Time Unlimited Access"
-    elif payment_type == "monthly":
-        amount_kobo = settings.MONTHLY_SUBSCRIPTION_AMOUNT_USD
-        description = "Monthly Subscription"
-    else:
+    try:
+        amount_kobo, description = _PAYMENT_PLANS[payment_type]
+    except KeyError:
         raise InvalidInputError(detail="Invalid payment type for Paystack", error_code="INVALID_PAYMENT_TYPE")
 
     reference = f"faceswap_{uuid_pkg.uuid4().hex}" # Unique reference for this transaction
@@ -49,13 +80,8 @@ async def initialize_paystack_payment(
     # The callback_url is where Paystack redirects the user after payment attempt.
     # Frontend should handle this URL, extract reference and call our verify endpoint.
     # Example: https://yourfrontend.com/paystack/callback
-    callback_url = f"{base_callback_url.rstrip('/')}/paystack/callback"
-
+    callback_url = _paystack_callback_url(base_callback_url)
 
-    headers = {
-        "Authorization": f"Bearer {settings.PAYSTACK_SECRET_KEY}",
-        "Content-Type": "application/json",
-    }
     payload = {
         "email": user.email,
         "amount": amount_kobo, # Amount in kobo/cents
@@ -74,10 +100,10 @@ async def initialize_paystack_payment(
     # This example handles it as a one-time or recurring payment managed by our app.
 
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(f"{settings.PAYSTACK_API_URL}/transaction/initialize", headers=headers, json=payload)
-            response.raise_for_status() # Will raise an exception for 4XX/5XX responses
-            data = response.json()
+        # The shared client already carries the base URL and Authorization header
+        response = await get_paystack_client().post("/transaction/initialize", content=orjson.dumps(payload))
+        response.raise_for_status() # Will raise an exception for 4XX/5XX responses
+        data = orjson.loads(response.content)
 
         if not data.get("status"):
             raise PaymentError(detail=f"Paystack initialization failed: {data.get('message')}", error_code="PAYSTACK_INIT_FAILED")
@@ -90,7 +116,8 @@ async def initialize_paystack_payment(
         if not all([authorization_url, access_code, returned_reference]):
             raise PaymentError(detail="Paystack initialization response missing crucial data.", error_code="PAYSTACK_INIT_INVALID_RESPONSE")
 
-        # Create a pending payment attempt
+        # The pending attempt is stored before any caller (coalesced ones included) gets the
+        # reference, so a verify or webhook for it can never arrive ahead of the attempt.
         await payment_repo.create_payment_attempt(
             user=user,
             amount=float(amount_kobo / 100), # Store as dollars/main unit
@@ -115,7 +142,7 @@ async def initialize_paystack_payment(
     except httpx.HTTPStatusError as e:
         error_detail = f"Paystack API error: {e.response.status_code} - {e.response.text}"
         try: # Try to parse Paystack's error message
-            error_body = e.response.json()
+            error_body = orjson.loads(e.response.content)
             error_detail = f"Paystack API error: {error_body.get('message', e.response.text)}"
         except:
             pass # Stick with default error_detail
@@ -124,106 +151,172 @@ async def initialize_paystack_payment(
         raise AppLogicError(detail=f"Error initializing Paystack payment: {str(e)}", error_code="PAYSTACK_INIT_EXCEPTION")
 
 
+async def _payment_owner(payment_attempt: PaymentAttempt, user: Optional[User]) -> User:
+    # Callers check a passed-in user against the attempt's owner first, so the linked document
+    # is only fetched for system calls (e.g. webhook) that have no user.
+    return user if user else await payment_attempt.user.fetch()
+
+async def _settle_paystack_transaction(
+    payment_attempt: PaymentAttempt,
+    paystack_tx_data: Dict[str, Any],
+    user: Optional[User]
+) -> PaymentStatusResponse:
+    # Applies a Paystack transaction (from the verify API or a signed webhook) to the attempt
+    paystack_status = paystack_tx_data.get("status")
+    
+    # Ensure the user from metadata matches, if available
+    tx_metadata = paystack_tx_data.get("metadata", {})
+    metadata_user_id = tx_metadata.get("user_id")
+    if user and metadata_user_id and str(user.id) != metadata_user_id:
+        # This is a serious issue, potentially a mismatched reference or security concern
+        await payment_repo.update_payment_attempt_status(payment_attempt, status="failed", metadata={"error": "User ID mismatch during verification"})
+        raise PaymentError(detail="User ID in transaction metadata does not match current user.", error_code="PAYSTACK_VERIFY_USER_MISMATCH")
+
+    payment_type = payment_attempt.metadata.get("payment_type") if payment_attempt.metadata else tx_metadata.get("payment_type")
+    if payment_type not in VALID_PAYMENT_TYPES:
+        await payment_repo.update_payment_attempt_status(payment_attempt, status="failed", metadata={"error": "Invalid payment type in metadata"})
+        raise PaymentError(detail="Invalid payment type in Paystack metadata", error_code="PAYSTACK_METADATA_INVALID")
+
+    if paystack_status == "success":
+        # Payment successful
+        # Amount verification (Paystack returns amount in kobo/cents)
+        amount_paid = paystack_tx_data.get("amount", 0)
+        expected_amount_kobo_cents = _PAYMENT_PLANS[payment_type][0]
+        
+        if amount_paid < expected_amount_kobo_cents: # Check if amount paid is at least what was expected
+             await payment_repo.update_payment_attempt_status(
+                payment_attempt, 
+                status="failed", 
+                metadata={"error": f"Amount paid ({amount_paid}) less than expected ({expected_amount_kobo_cents})"}
+            )
+             raise PaymentError(detail="Amount paid does not match expected amount.", error_code="PAYSTACK_AMOUNT_MISMATCH")
+
+        # transaction_id is already the reference. Can add Paystack's internal ID if needed.
+        # Only the verifier that wins the transition activates the subscription.
+        claimed = await payment_repo.mark_payment_attempt_succeeded(payment_attempt)
+
+        # The user associated with the payment attempt (fetched only for system calls)
+        payment_user = await _payment_owner(payment_attempt, user)
+        if claimed:
+            try:
+                await payment_repo.create_or_update_subscription(
+                    user=payment_user,
+                    subscription_type=payment_type, 
+                    status="active"
+                    # For Paystack managed subscriptions, you'd store paystack_tx_data.get("subscription_code")
+                )
+            except Exception:
+                # The attempt only stays succeeded once the subscription is stored
+                await payment_repo.release_payment_attempt_claim(payment_attempt)
+                raise
+        _succeeded_paystack_references[payment_attempt.transaction_id] = payment_user.id
+        return await get_user_payment_status(payment_user)
+    
+    elif paystack_status == "abandoned":
+        await payment_repo.update_payment_attempt_status(payment_attempt, status="abandoned")
+        raise PaymentError(detail="Paystack payment was abandoned.", error_code="PAYSTACK_PAYMENT_ABANDONED")
+    else: # failed, pending, etc.
+        await payment_repo.update_payment_attempt_status(payment_attempt, status="failed", metadata={"paystack_status": paystack_status})
+        raise PaymentError(detail=f"Paystack payment not successful: {paystack_status}", error_code="PAYSTACK_PAYMENT_NOT_SUCCESSFUL")
+
+async def _recover_paystack_attempt(
+    reference: str,
+    paystack_tx_data: Dict[str, Any],
+    user: Optional[User]
+) -> Optional[PaymentAttempt]:
+    # Rebuilds an attempt that was never stored from the metadata our initialize call sent to
+    # Paystack. None when the transaction does not carry it (not one of ours) or names another user.
+    tx_metadata = paystack_tx_data.get("metadata") or {}
+    metadata_user_id = tx_metadata.get("user_id")
+    payment_type = tx_metadata.get("payment_type")
+    if not metadata_user_id or payment_type not in VALID_PAYMENT_TYPES:
+        return None
+    if user is None:
+        try:
+            user = await user_repo.get_user_by_id(uuid_pkg.UUID(metadata_user_id))
+        except ValueError:
+            return None
+        if user is None:
+            return None
+    elif str(user.id) != metadata_user_id:
+        return None
+    return await payment_repo.get_or_create_payment_attempt_by_reference(
+        user=user,
+        reference=reference,
+        payment_processor="paystack",
+        amount=float(paystack_tx_data.get("amount", 0) / 100), # Store as dollars/main unit
+        currency=str(paystack_tx_data.get("currency") or "USD").lower(),
+        metadata={"payment_type": payment_type, "description": tx_metadata.get("description"), "recovered": True},
+    )
+
+# In-flight verifications keyed by (reference, user id). Retries of the same reference share one
+# Paystack call and one set of DB writes instead of racing to activate the subscription twice.
+_inflight_paystack_verifications: Dict[Tuple[str, Optional[uuid_pkg.UUID]], asyncio.Future] = {}
+
+# Owner id per reference that has already succeeded. Success is terminal, so frontend polling
+# skips both the Mongo lookup and the Paystack call. Only the owner is cached, not the response:
+# the status is rebuilt from the caller's user so requests_remaining is never stale.
+_succeeded_paystack_references: TTLCache = TTLCache(maxsize=10000, ttl=300)
+
 async def verify_paystack_payment(reference: str, user: User) -> PaymentStatusResponse:
+    if user and _succeeded_paystack_references.get(reference) == user.id:
+        return await get_user_payment_status(user)
+
+    key = (reference, user.id if user else None)
+    verification = _inflight_paystack_verifications.get(key)
+    if verification is None:
+        verification = asyncio.ensure_future(_verify_paystack_payment(reference, user))
+        _inflight_paystack_verifications[key] = verification
+        verification.add_done_callback(lambda _: _inflight_paystack_verifications.pop(key, None))
+    # Shielded so one disconnecting caller does not cancel the verification for the others
+    return await asyncio.shield(verification)
+
+async def _verify_paystack_payment(reference: str, user: User) -> PaymentStatusResponse:
     if not settings.PAYSTACK_SECRET_KEY:
         raise AppLogicError(detail="Paystack not configured", error_code="PAYSTACK_NOT_CONFIGURED")
 
-    headers = {
-        "Authorization": f"Bearer {settings.PAYSTACK_SECRET_KEY}",
-    }
-
+    payment_attempt = None
     try:
-        payment_attempt = await PaymentAttempt.find_one(
-            PaymentAttempt.transaction_id == reference,
-            PaymentAttempt.payment_processor == "paystack"
-        )
-        if not payment_attempt:
-            raise NotFoundError(detail=f"Payment attempt with reference {reference} not found for Paystack.", error_code="PAYSTACK_PAYMENT_ATTEMPT_NOT_FOUND")
-        
-        # Ensure the payment attempt belongs to the current user, though reference should be unique enough
-        # Be cautious if user is None for some verification flows (e.g. webhook)
-        if user and payment_attempt.user.ref.id != user.id:
-             raise AppLogicError(detail="Payment attempt does not belong to this user.", error_code="PAYSTACK_USER_MISMATCH")
+        payment_attempt = await payment_repo.get_payment_attempt_by_reference(reference, "paystack")
+        if payment_attempt:
+            # Ensure the payment attempt belongs to the current user, though reference should be unique enough
+            # Be cautious if user is None for some verification flows (e.g. webhook)
+            if user and payment_attempt.user.ref.id != user.id:
+                 raise AppLogicError(detail="Payment attempt does not belong to this user.", error_code="PAYSTACK_USER_MISMATCH")
 
+            if payment_attempt.status == "succeeded":
+                 # If already successful, just return current status, don't re-verify unless necessary
+                payment_user = await _payment_owner(payment_attempt, user)
+                _succeeded_paystack_references[reference] = payment_user.id
+                return await get_user_payment_status(payment_user)
 
-        if payment_attempt.status == "succeeded":
-             # If already successful, just return current status, don't re-verify unless necessary
-            return await get_user_payment_status(await payment_attempt.user.fetch())
 
+        response = await get_paystack_client().get(f"/transaction/verify/{reference}")
+        response.raise_for_status()
+        data = orjson.loads(response.content)
 
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{settings.PAYSTACK_API_URL}/transaction/verify/{reference}", headers=headers)
-            response.raise_for_status()
-            data = response.json()
+        if not payment_attempt:
+            # No stored attempt for this reference: rebuild it from the transaction's own metadata,
+            # which only succeeds when Paystack confirms the reference and it belongs to this user.
+            if data.get("status"):
+                payment_attempt = await _recover_paystack_attempt(reference, data.get("data") or {}, user)
+            if not payment_attempt or (user and payment_attempt.user.ref.id != user.id):
+                raise NotFoundError(detail=f"Payment attempt with reference {reference} not found for Paystack.", error_code="PAYSTACK_PAYMENT_ATTEMPT_NOT_FOUND")
+            if payment_attempt.status == "succeeded": # Settled concurrently by the webhook
+                payment_user = await _payment_owner(payment_attempt, user)
+                _succeeded_paystack_references[reference] = payment_user.id
+                return await get_user_payment_status(payment_user)
 
         if not data.get("status"):
             await payment_repo.update_payment_attempt_status(payment_attempt, status="failed", metadata={"error": data.get("message", "Verification check failed")})
             raise PaymentError(detail=f"Paystack verification failed: {data.get('message')}", error_code="PAYSTACK_VERIFY_FAILED_API")
 
-        paystack_tx_data = data.get("data", {})
-        paystack_status = paystack_tx_data.get("status")
-        
-        # Ensure the user from metadata matches, if available
-        tx_metadata = paystack_tx_data.get("metadata", {})
-        metadata_user_id = tx_metadata.get("user_id")
-        if user and metadata_user_id and str(user.id) != metadata_user_id:
-            # This is a serious issue, potentially a mismatched reference or security concern
-            await payment_repo.update_payment_attempt_status(payment_attempt, status="failed", metadata={"error": "User ID mismatch during verification"})
-            raise PaymentError(detail="User ID in transaction metadata does not match current user.", error_code="PAYSTACK_VERIFY_USER_MISMATCH")
-
-        payment_type = payment_attempt.metadata.get("payment_type") if payment_attempt.metadata else tx_metadata.get("payment_type")
-        if not payment_type or payment_type not in ["one_time", "monthly"]:
-            await payment_repo.update_payment_attempt_status(payment_attempt, status="failed", metadata={"error": "Invalid payment type in metadata"})
-            raise PaymentError(detail="Invalid payment type in Paystack metadata", error_code="PAYSTACK_METADATA_INVALID")
-
-        if paystack_status == "success":
-            # Payment successful
-            # Amount verification (Paystack returns amount in kobo/cents)
-            amount_paid = paystack_tx_data.get("amount", 0)
-            expected_amount_kobo_cents = 0
-            if payment_type == "one_time":
-                expected_amount_kobo_cents = settings.ONE_TIME_PAYMENT_AMOUNT_USD
-            elif payment_type == "monthly":
-                expected_amount_kobo_cents = settings.MONTHLY_SUBSCRIPTION_AMOUNT_USD
-            
-            if amount_paid < expected_amount_kobo_cents: # Check if amount paid is at least what was expected
-                 await payment_repo.update_payment_attempt_status(
-                    payment_attempt, 
-                    status="failed", 
-                    metadata={"error": f"Amount paid ({amount_paid}) less than expected ({expected_amount_kobo_cents})"}
-                )
-                 raise PaymentError(detail="Amount paid does not match expected amount.", error_code="PAYSTACK_AMOUNT_MISMATCH")
-
-            await payment_repo.update_payment_attempt_status(
-                payment_attempt, 
-                status="succeeded",
-                # transaction_id is already the reference. Can add Paystack's internal ID if needed.
-                # metadata={"paystack_transaction_id": paystack_tx_data.get("id")} # Example
-            )
-            
-            # Fetch the user associated with the payment attempt
-            # This is important if 'user' param to this function could be different (e.g. system call)
-            payment_user = await payment_attempt.user.fetch()
-
-            await payment_repo.create_or_update_subscription(
-                user=payment_user,
-                subscription_type=payment_type, 
-                status="active"
-                # For Paystack managed subscriptions, you'd store paystack_tx_data.get("subscription_code")
-            )
-            return await get_user_payment_status(payment_user)
-        
-        elif paystack_status == "abandoned":
-            await payment_repo.update_payment_attempt_status(payment_attempt, status="abandoned")
-            raise PaymentError(detail="Paystack payment was abandoned.", error_code="PAYSTACK_PAYMENT_ABANDONED")
-        else: # failed, pending, etc.
-            await payment_repo.update_payment_attempt_status(payment_attempt, status="failed", metadata={"paystack_status": paystack_status})
-            raise PaymentError(detail=f"Paystack payment not successful: {paystack_status}", error_code="PAYSTACK_PAYMENT_NOT_SUCCESSFUL")
+        return await _settle_paystack_transaction(payment_attempt, data.get("data", {}), user)
 
     except httpx.HTTPStatusError as e:
         error_detail = f"Paystack API error during verification: {e.response.status_code} - {e.response.text}"
         try:
-            error_body = e.response.json()
+            error_body = orjson.loads(e.response.content)
             error_detail = f"Paystack API error during verification: {error_body.get('message', e.response.text)}"
             # Update attempt based on API error if possible
             if payment_attempt and payment_attempt.status != "succeeded":
@@ -237,17 +330,55 @@ async def verify_paystack_payment(reference: str, user: User) -> PaymentStatusRe
         raise AppLogicError(detail=f"Error verifying Paystack payment: {str(e)}", error_code="PAYSTACK_VERIFICATION_EXCEPTION")
 
 
+# Paystack retries a webhook until it gets a 2xx, so references already settled through one are skipped
+_processed_paystack_webhooks: TTLCache = TTLCache(maxsize=10000, ttl=3600)
+
+async def handle_paystack_webhook(payload: bytes, signature: Optional[str]) -> None:
+    # The event is HMAC-SHA512 signed with our secret key, so its transaction data is trusted as-is
+    # and no /transaction/verify round trip to Paystack is needed.
+    if not settings.PAYSTACK_SECRET_KEY:
+        raise AppLogicError(detail="Paystack not configured", error_code="PAYSTACK_NOT_CONFIGURED")
+    expected_signature = hmac.new(settings.PAYSTACK_SECRET_KEY.encode(), payload, hashlib.sha512).hexdigest()
+    if not signature or not hmac.compare_digest(expected_signature, signature):
+        raise PaymentError(detail="Invalid Paystack webhook signature", error_code="PAYSTACK_WEBHOOK_INVALID_SIGNATURE", status_code=401)
+
+    event = orjson.loads(payload)
+    if event.get("event") != "charge.success":
+        return
+    paystack_tx_data = event.get("data") or {}
+    reference = paystack_tx_data.get("reference")
+    if not reference or reference in _processed_paystack_webhooks:
+        return
+
+    # Settled before responding: any failure propagates as a non-2xx so Paystack redelivers the event,
+    # and the reference is only marked processed once the payment is actually applied.
+    payment_attempt = await payment_repo.get_payment_attempt_by_reference(reference, "paystack")
+    if not payment_attempt:
+        # The signed event carries the reference and our initialize metadata, which is enough to
+        # store the attempt here rather than depend on the one written at initialization.
+        payment_attempt = await _recover_paystack_attempt(reference, paystack_tx_data, user=None)
+    if not payment_attempt:
+        logger.warning("Paystack webhook for %s ignored: no attempt and no usable metadata", reference)
+        return # Redelivering the same event cannot change that
+    if payment_attempt.status != "succeeded":
+        try:
+            await _settle_paystack_transaction(payment_attempt, paystack_tx_data, user=None)
+        except PaymentError as e:
+            # A rejected transaction (amount or metadata mismatch) is recorded on the attempt and a
+            # redelivery would be rejected the same way, so it is acknowledged but not marked processed.
+            logger.warning("Paystack webhook for %s not applied: %s", reference, e.detail)
+            return
+    _processed_paystack_webhooks[reference] = True
+
+
 # --- USDT and common functions remain largely unchanged ---
 async def initiate_usdt_payment(user: User, payment_type: Literal["one_time", "monthly"]) -> USDTTransactionResponse:
     if not settings.USDT_ETH_WALLET_ADDRESS:
         raise AppLogicError(detail="USDT payment not configured", error_code="USDT_NOT_CONFIGURED")
 
-    expected_amount_usd = 0.0
-    if payment_type == "one_time":
-        expected_amount_usd = float(settings.ONE_TIME_PAYMENT_AMOUNT_USD / 100)
-    elif payment_type == "monthly":
-        expected_amount_usd = float(settings.MONTHLY_SUBSCRIPTION_AMOUNT_USD / 100)
-    else:
+    try:
+        expected_amount_usd = float(_PAYMENT_PLANS[payment_type][0] / 100)
+    except KeyError:
         raise InvalidInputError(detail="Invalid payment type for USDT payment", error_code="INVALID_PAYMENT_TYPE")
 
     payment_attempt = await payment_repo.create_payment_attempt(
@@ -272,115 +403,77 @@ async def confirm_usdt_payment(
     user: User,
     payment_attempt_id: uuid_pkg.UUID, # Renamed to avoid conflict
     transaction_hash: str,
-    background_tasks: BackgroundTasks
 ) -> PaymentStatusResponse:
-    payment_attempt = await payment_repo.get_payment_attempt(payment_attempt_id)
-    if not payment_attempt or payment_attempt.user.ref.id != user.id:
-        raise NotFoundError(detail="Payment attempt not found or does not belong to user", error_code="USDT_PAYMENT_ATTEMPT_NOT_FOUND")
-    
-    if payment_attempt.status == "succeeded":
-        raise AppLogicError(detail="This payment has already been confirmed.", error_code="USDT_ALREADY_CONFIRMED")
-    if payment_attempt.status == "failed":
-        raise PaymentError(detail="This payment attempt was previously marked as failed.", error_code="USDT_PAYMENT_FAILED_PREVIOUSLY")
-
-    # Basic validation of transaction_hash format (moved from endpoint to service)
-    if not transaction_hash.startswith("0x") or len(transaction_hash) != 66:
-        raise InvalidInputError(detail="Invalid transaction hash format.", error_code="INVALID_TX_HASH")
-
-    payment_attempt.transaction_id = transaction_hash # Store blockchain hash
-    payment_attempt.status = "pending" # Mark as pending verification (can also be 'requires_action')
-    await payment_attempt.save()
-    
     # SIMULATED SUCCESS (as before)
-    payment_type = payment_attempt.metadata.get("payment_type") if payment_attempt.metadata else None
-    if not payment_type or payment_type not in ["one_time", "monthly"]:
+    # Stores the blockchain hash and marks the attempt succeeded in one guarded write
+    try:
+        payment_attempt = await payment_repo.claim_payment_attempt(
+            payment_attempt_id, user.id, transaction_hash, VALID_PAYMENT_TYPES
+        )
+    except DuplicateKeyError: # transaction_id is unique, so a hash can only confirm one attempt
+        raise DuplicateResourceError(detail="This transaction hash has already been used.", error_code="USDT_TX_HASH_ALREADY_USED")
+    if payment_attempt is None:
+        # The claim was refused; one more read tells us why
+        payment_attempt = await payment_repo.get_payment_attempt(payment_attempt_id)
+        if not payment_attempt or payment_attempt.user.ref.id != user.id:
+            raise NotFoundError(detail="Payment attempt not found or does not belong to user", error_code="USDT_PAYMENT_ATTEMPT_NOT_FOUND")
+        if payment_attempt.status == "succeeded":
+            raise AppLogicError(detail="This payment has already been confirmed.", error_code="USDT_ALREADY_CONFIRMED")
+        if payment_attempt.status == "failed":
+            raise PaymentError(detail="This payment attempt was previously marked as failed.", error_code="USDT_PAYMENT_FAILED_PREVIOUSLY")
         await payment_repo.update_payment_attempt_status(payment_attempt, status="failed", metadata={"error": "Invalid payment type in metadata"})
         raise PaymentError(detail="Invalid payment type in payment attempt metadata", error_code="USDT_METADATA_INVALID")
 
-    await payment_repo.update_payment_attempt_status(payment_attempt, status="succeeded", transaction_id=transaction_hash)
-    await payment_repo.create_or_update_subscription(
-        user=user,
-        subscription_type=payment_type,
-        status="active"
-    )
+    # The subscription is stored before responding; if that fails the claim is released, so the
+    # attempt is never left succeeded without the subscription it paid for.
+    try:
+        await payment_repo.create_or_update_subscription(
+            user=user,
+            subscription_type=payment_attempt.metadata["payment_type"],
+            status="active",
+        )
+    except Exception:
+        await payment_repo.release_payment_attempt_claim(payment_attempt)
+        raise
     return await get_user_payment_status(user)
 
 
-async def get_user_payment_status(user: User) -> PaymentStatusResponse:
-    # Ensure user object has subscription details potentially fetched/updated
-    # This might involve reloading the user or ensuring links are fetched if subscription is a separate doc
-    # For this example, we assume user object passed is up-to-date after payment operations.
-    # However, if User.subscription_id is a Link, it needs to be fetched.
-    # The User model in snippet does not show subscription_id as a Link, but fields like
-    # user.subscription_type, user.subscription_start_date, user.subscription_end_date
-    # These are assumed to be updated by `create_or_update_subscription` in `payment`.
-
-    # Let's ensure user object is fresh if it's been modified in DB by other functions
-    await user.reload() 
-
-    is_active_subscriber = False
-    requests_remaining = None
+async def get_user_payment_status(user: User, background_tasks: Optional[BackgroundTasks] = None) -> PaymentStatusResponse:
+    # Pure field access on the user document: no reload and no cycle heuristics. A new monthly cycle
+    # starts with a renewal, and create_or_update_subscription resets monthly_requests_used then.
+    user_repo.refresh_access_state(user, now=cached_utcnow())
+    requests_remaining = user.requests_remaining
     sub_end_date_str = None
-    message = "User is on the free tier or subscription has expired."
-    current_time = datetime.utcnow()
 
-    if user.subscription_type == "one_time":
-        # Check if start_date exists, implying a successful one-time purchase
-        if user.subscription_start_date: # A one-time purchase should have a start date
+    match user.effective_tier:
+        case "one_time":
             is_active_subscriber = True
-            requests_remaining = None # Unlimited
             message = "User has a one-time unlimited access subscription."
-        else: # Never actually made a one-time payment
-            user.subscription_type = "none" 
-            # Fall through to free tier logic
-
-    if user.subscription_type == "monthly": # Changed from elif to if to allow falling from failed one_time
-        if user.subscription_end_date and user.subscription_end_date > current_time:
+        case "monthly":
             is_active_subscriber = True
-            
-            # Reset monthly count if new billing cycle started
-            # This logic might be better in a periodic task or upon first request of new cycle
-            if user.subscription_start_date and user.last_request_date:
-                # Approximate check: if last request was before current cycle's start
-                current_cycle_start_date = user.subscription_end_date - timedelta(days=30) # Approximation
-                if user.last_request_date < current_cycle_start_date:
-                    if user.monthly_requests_used > 0:
-                        await user.reset_monthly_user_request_count(user.id) # Assuming user takes user_id
-                        await user.reload() # refresh user data
-
-            requests_remaining = settings.MONTHLY_REQUEST_LIMIT - user.monthly_requests_used
             sub_end_date_str = user.subscription_end_date.isoformat()
             message = f"User has an active monthly subscription. Requests remaining: {requests_remaining}."
-        elif user.subscription_end_date and user.subscription_end_date <= current_time:
-            message = "User's monthly subscription has expired."
-            # user.subscription_type = "none" # Or "expired"
-            # await user.save() # Persist this change
-            # Fall through to free tier logic if subscription expired
-
-    if not is_active_subscriber: # Handles free tier, expired, or never subscribed
-        # If user type became 'none' from expired or failed one_time, reset it for free tier message.
-        # Or ensure user.subscription_type reflects an 'expired' state distinctly.
-        # For simplicity, if not active, they are on 'free tier' equivalent for request counting.
-        
-        requests_remaining = settings.FREE_REQUEST_LIMIT - user.free_requests_used
-        message = f"User is on the free tier. Free requests remaining: {max(0, requests_remaining)}."
-        if requests_remaining <=0:
-            message = f"User has used all free requests. Please subscribe."
-        
-        # This part seems to manage a specific 'free_tier_used' status on the user model.
-        # If the user was previously 'monthly' or 'one_time' but is no longer active,
-        # they revert to free tier logic. The 'free_tier_used' status indicates they've
-        # exhausted free tier AND were never subscribed, or their subscription fully lapsed.
-        # This might need refinement based on exact desired UX for lapsed subscribers vs new free users.
-        # For now, if they aren't an active subscriber and have no free requests, update status if they are 'none'.
-        if requests_remaining <= 0 and user.subscription_type == "none":
-            user.subscription_type = "free_tier_used" # Mark that free tier is exhausted
-            await user.save()
-
+        case _: # Free tier, expired monthly, or never subscribed
+            is_active_subscriber = False
+            if requests_remaining <= 0:
+                message = "User has used all free requests. Please subscribe."
+            else:
+                message = f"User is on the free tier. Free requests remaining: {requests_remaining}."
+            if user.effective_tier == "expired":
+                message = f"User's monthly subscription has expired. {message}"
+
+    # The 'free_tier_used' status marks users who exhausted the free tier without ever subscribing.
+    subscription_type = str(user.subscription_type) # Ensure it's a string
+    if requests_remaining == 0 and subscription_type == "none":
+        subscription_type = "free_tier_used"
+        if background_tasks is not None: # Written after the response when the caller can defer it
+            background_tasks.add_task(user_repo.mark_free_tier_used, user)
+        else:
+            await user_repo.mark_free_tier_used(user)
 
     return PaymentStatusResponse(
         user_id=user.id,
-        subscription_type=str(user.subscription_type), # Ensure it's a string
+        subscription_type=subscription_type,
         is_active_subscriber=is_active_subscriber,
         requests_remaining=requests_remaining,
         subscription_end_date=sub_end_date_str,
@@ -2,5 +2,8 @@ from app.models.user import User
 from app.schemas.user_schemas import UserResponse
 from app.repositories import user as user_repo
 
+def user_to_response(user: User) -> UserResponse:
+    return UserResponse.model_validate(user, from_attributes=True)
+
 async def get_user_profile(user: User) -> UserResponse:
-    return UserResponse.model_validate(user)
\ No newline at end of file
+    return user_to_response(user)
\ No newline at end of file
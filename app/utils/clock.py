@@ -0,0 +1,19 @@
+from datetime import datetime, timezone
+import time
+
+# Subscription checks only need second-level precision, so hot paths share a utcnow()
+# snapshot that is refreshed at most once per CLOCK_RESOLUTION_SECONDS.
+CLOCK_RESOLUTION_SECONDS = 1.0
+
+def utcnow() -> datetime:
+    # Naive UTC, matching what Mongo returns, without the deprecated datetime.utcnow()
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+_snapshot = {"utc": utcnow(), "monotonic": time.monotonic()}
+
+def cached_utcnow() -> datetime:
+    monotonic_now = time.monotonic()
+    if monotonic_now - _snapshot["monotonic"] > CLOCK_RESOLUTION_SECONDS:
+        _snapshot["utc"] = utcnow()
+        _snapshot["monotonic"] = monotonic_now
+    return _snapshot["utc"]
@@ -1,8 +1,9 @@
 from fastapi import HTTPException, status
+from typing import Dict, Optional
 
 class AppExceptionBase(HTTPException):
-    def __init__(self, status_code: int, detail: str, error_code: str):
-        super().__init__(status_code=status_code, detail=detail)
+    def __init__(self, status_code: int, detail: str, error_code: str, headers: Optional[Dict[str, str]] = None):
+        super().__init__(status_code=status_code, detail=detail, headers=headers)
         self.error_code = error_code
 
 class NotFoundError(AppExceptionBase):
@@ -14,12 +15,14 @@ class DuplicateResourceError(AppExceptionBase):
         super().__init__(status_code=status.HTTP_409_CONFLICT, detail=detail, error_code=error_code)
 
 class AuthError(AppExceptionBase):
+    _HEADERS = {"WWW-Authenticate": "Bearer"} # For JWT; shared by every instance, never mutated
+
     def __init__(self, detail: str = "Authentication failed", error_code: str = "AUTH_FAILED"):
         super().__init__(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail=detail,
             error_code=error_code,
-            headers={"WWW-Authenticate": "Bearer"}, # For JWT
+            headers=self._HEADERS,
         )
 
 class ForbiddenError(AppExceptionBase):
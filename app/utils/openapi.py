@@ -0,0 +1,17 @@
+from typing import Any, Dict
+import msgspec
+
+# FastAPI only documents pydantic models, so routes using msgspec Structs describe them explicitly.
+
+def msgspec_json_schema(struct_type: type) -> Dict[str, Any]:
+    # The Structs documented here are flat, so their component schema can be inlined as-is
+    _, components = msgspec.json.schema_components((struct_type,))
+    return components[struct_type.__name__]
+
+def msgspec_request_body(struct_type: type) -> Dict[str, Any]:
+    # openapi_extra for routes whose body is decoded by app.core.dependencies.msgspec_body
+    return {"requestBody": {"required": True, "content": {"application/json": {"schema": msgspec_json_schema(struct_type)}}}}
+
+def msgspec_responses(struct_type: type) -> Dict[int, Dict[str, Any]]:
+    # responses= for routes that return a Struct through app.core.responses.MsgspecResponse
+    return {200: {"content": {"application/json": {"schema": msgspec_json_schema(struct_type)}}}}
\ No newline at end of file
@@ -0,0 +1,10 @@
+# Validation constants are built once at import rather than per request.
+TX_HASH_PREFIX = "0x"
+TX_HASH_LENGTH = len(TX_HASH_PREFIX) + 64 # "0x" followed by 64 hex digits
+_HEX_DIGITS = b"0123456789abcdefABCDEF"
+
+def is_valid_tx_hash(transaction_hash: str) -> bool:
+    if len(transaction_hash) != TX_HASH_LENGTH or not transaction_hash.startswith(TX_HASH_PREFIX) or not transaction_hash.isascii():
+        return False
+    # bytes.translate drops every hex digit in a single C-level pass; anything left over is not hex.
+    return not transaction_hash[2:].encode("ascii").translate(None, _HEX_DIGITS)
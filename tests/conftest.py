@@ -7,19 +7,29 @@ if project_root not in sys.path:
 
 import pytest
 import pytest_asyncio
-import asyncio # Added for the session-scoped event_loop
-from httpx import AsyncClient
+from httpx import ASGITransport, AsyncClient
 from typing import AsyncGenerator, Generator, Dict, Any
 from unittest import mock
+from contextlib import ExitStack
 import uuid
 from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+import pkgutil
+
+from beanie import init_beanie
+from beanie.odm.fields import Link
+from mongomock_motor import AsyncMongoMockClient
+from passlib.context import CryptContext
+from pymongo.errors import DuplicateKeyError
 
 from app.main import app # app must be imported after settings are potentially patched or loaded
 from app.core.config import settings
-from app.core.security import create_access_token, create_refresh_token, get_password_hash
+from app.core.security import create_access_token, create_refresh_token
 from app.models.user import User
+from app.models.payment import PaymentAttempt, Subscription
+from app.repositories.user import refresh_access_state
 # from app.db.mongodb_utils import connect_to_mongo, close_mongo_connection # Not directly used if mocked in lifespan
-from tests.utils.mock_data import create_mock_user
+from tests.utils.mock_data import cached_password_hash, create_mock_user, mock_now, mock_uuid
 
 # Override settings for testing if necessary
 # CRITICAL: Ensure DATABASE_NAME is set for tests
@@ -32,27 +42,17 @@ settings.GOOGLE_CLIENT_SECRET = "test_google_client_secret"
 settings.GOOGLE_REDIRECT_URI = "http://testserver/api/v1/auth/google/callback"
 
 
-@pytest.fixture(scope="session")
-def event_loop():
-    """
-    Create an instance of the default event loop for the entire session.
-    pytest-asyncio uses this to run session-scoped async fixtures.
-    """
-    policy = asyncio.get_event_loop_policy()
-    loop = policy.new_event_loop()
-    asyncio.set_event_loop(loop)
-    yield loop
-    loop.close()
-
-
 @pytest_asyncio.fixture(scope="session", autouse=True)
-async def app_lifespan_manager(): # Removed event_loop from signature
+async def app_lifespan_manager():
     # This fixture will manage the app's lifespan for the entire test session.
     # We mock connect_to_mongo and close_mongo_connection where they are called by the lifespan manager (app.main)
     
     # Patching where connect_to_mongo and close_mongo_connection are looked up by app.main.lifespan
+    # The counter batcher is stubbed too: its loop would write to Mongo in the background, and the
+    # tests that cover it drive flush() directly.
     with mock.patch("app.main.connect_to_mongo", new_callable=mock.AsyncMock) as mock_connect, \
-         mock.patch("app.main.close_mongo_connection", new_callable=mock.AsyncMock) as mock_close:
+         mock.patch("app.main.close_mongo_connection", new_callable=mock.AsyncMock) as mock_close, \
+         mock.patch("app.main.counter_batcher", mock.Mock(start=mock.Mock(), stop=mock.AsyncMock())):
         # Simulate lifespan startup
         async with app.router.lifespan_context(app):
             yield # Tests run here
@@ -61,72 +61,170 @@ async def app_lifespan_manager(): # Removed event_loop from signature
         mock_close.assert_called_once() # Ensure lifespan shutdown mock was called
 
 
-@pytest_asyncio.fixture(scope="function")
+@pytest.fixture(scope="session", autouse=True)
+def fast_password_hashing():
+    # Same schemes and verify/rehash logic as production, at the minimum argon2 cost; a
+    # production-cost hash per created user would dominate the suite's runtime.
+    test_pwd_context = CryptContext(
+        schemes=["argon2", "bcrypt"],
+        deprecated="auto",
+        argon2__rounds=1,
+        argon2__memory_cost=8,
+        argon2__parallelism=1,
+        bcrypt__rounds=4,
+    )
+    with mock.patch("app.core.security.pwd_context", test_pwd_context), \
+         mock.patch("app.core.security._default_hasher", test_pwd_context.handler()):
+        yield
+
+
+# The client, the mock stores and the CRUD patches below are built once per session;
+# reset_mock_state empties the stores before every test instead.
+@pytest_asyncio.fixture(scope="session")
 async def client() -> AsyncGenerator[AsyncClient, None]:
-    async with AsyncClient(app=app, base_url="http://testserver") as c:
+    # One explicit ASGITransport for the session (httpx 0.27 deprecates AsyncClient(app=...))
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://testserver") as c:
         yield c
 
-@pytest.fixture(scope="function")
+class MockUserStore(dict):
+    # Keeps an email index in step with every write (fixtures and tests assign users directly),
+    # so lookups by email are a dict get instead of a scan of every user
+    def __init__(self):
+        super().__init__()
+        self.by_email: Dict[str, User] = {}
+
+    def __setitem__(self, user_id: uuid.UUID, user: User):
+        super().__setitem__(user_id, user)
+        self.by_email[user.email] = user
+
+    def clear(self):
+        super().clear()
+        self.by_email.clear()
+
+@pytest.fixture(scope="session")
 def mock_user_db() -> Dict[uuid.UUID, User]:
-    return {}
+    return MockUserStore()
 
-@pytest.fixture(scope="function")
+@pytest.fixture(scope="session")
 def mock_google_id_db() -> Dict[str, User]:
     return {}
     
-@pytest.fixture(scope="function")
+@pytest.fixture(scope="session")
 def mock_payment_attempt_db() -> Dict[uuid.UUID, Any]: # Store mock PaymentAttempt
     return {}
 
-@pytest.fixture(scope="function")
+class MockSubscriptionStore(dict):
+    # Keeps a user id -> subscription index in step with every write, like MockUserStore
+    def __init__(self):
+        super().__init__()
+        self.by_user: Dict[uuid.UUID, Any] = {}
+
+    def __setitem__(self, sub_id: uuid.UUID, subscription: Any):
+        super().__setitem__(sub_id, subscription)
+        user = subscription.user
+        self.by_user[user.ref.id if isinstance(user, Link) else user.id] = subscription
+
+    def clear(self):
+        super().clear()
+        self.by_user.clear()
+
+@pytest.fixture(scope="session")
 def mock_subscription_db() -> Dict[uuid.UUID, Any]: # Store mock Subscription
-    return {}
+    return MockSubscriptionStore()
+
+@pytest.fixture(scope="function", autouse=True)
+def reset_mock_state(mock_user_db, mock_google_id_db, mock_payment_attempt_db, mock_subscription_db):
+    mock_user_db.clear()
+    mock_google_id_db.clear()
+    mock_payment_attempt_db.clear()
+    mock_subscription_db.clear()
+
+
+# Fixed ids let the signed access tokens below be reused across tests; the stores are reset per test
+TEST_USER_ID = uuid.UUID("5b0f8f4e-3a8e-4c47-9a55-6a1c0f1e2d01")
+TEST_GOOGLE_USER_ID = uuid.UUID("5b0f8f4e-3a8e-4c47-9a55-6a1c0f1e2d02")
 
+@lru_cache(maxsize=None)
+def cached_access_token(user_id: uuid.UUID) -> str:
+    return create_access_token(subject=user_id)
+
+
+@pytest.fixture(scope="session")
+def prototype_users(fast_password_hashing) -> Dict[str, User]:
+    # Validated (and password-hashed) once; the per-test fixtures insert cheap copies
+    return {
+        "test": create_mock_user(email="test@example.com", password="password", user_id=TEST_USER_ID),
+        "google": create_mock_user(
+            email="googleuser@example.com",
+            password=None, # Google users might not have a password initially
+            google_id="test_google_id_123",
+            user_id=TEST_GOOGLE_USER_ID
+        ),
+        "other": create_mock_user(email="other@example.com", password="password", user_id=mock_uuid()),
+    }
 
 @pytest_asyncio.fixture(scope="function")
-async def test_user(mock_user_db: Dict[uuid.UUID, User]) -> User:
-    user = create_mock_user(email="test@example.com", password="password", user_id=uuid.uuid4())
+async def test_user(mock_user_db: Dict[uuid.UUID, User], prototype_users: Dict[str, User]) -> User:
+    user = prototype_users["test"].model_copy()
     mock_user_db[user.id] = user
     return user
 
 @pytest_asyncio.fixture(scope="function")
-async def test_user_google(mock_user_db: Dict[uuid.UUID, User], mock_google_id_db: Dict[str, User]) -> User:
-    user = create_mock_user(
-        email="googleuser@example.com",
-        password=None, # Google users might not have a password initially
-        google_id="test_google_id_123",
-        user_id=uuid.uuid4()
-    )
+async def test_user_google(mock_user_db: Dict[uuid.UUID, User], mock_google_id_db: Dict[str, User], prototype_users: Dict[str, User]) -> User:
+    user = prototype_users["google"].model_copy()
     mock_user_db[user.id] = user
     mock_google_id_db[user.google_id] = user
     return user
     
 @pytest_asyncio.fixture(scope="function")
-async def other_user(mock_user_db: Dict[uuid.UUID, User]) -> User:
-    user = create_mock_user(email="other@example.com", password="password", user_id=uuid.uuid4())
+async def other_user(mock_user_db: Dict[uuid.UUID, User], prototype_users: Dict[str, User]) -> User:
+    user = prototype_users["other"].model_copy()
     mock_user_db[user.id] = user
     return user
 
 
 @pytest.fixture(scope="function")
 def auth_headers_for_user(test_user: User) -> Dict[str, str]:
-    access_token = create_access_token(subject=test_user.id)
+    access_token = cached_access_token(test_user.id)
     return {"Authorization": f"Bearer {access_token}"}
 
 @pytest.fixture(scope="function")
 def auth_headers_for_google_user(test_user_google: User) -> Dict[str, str]:
-    access_token = create_access_token(subject=test_user_google.id)
+    access_token = cached_access_token(test_user_google.id)
     return {"Authorization": f"Bearer {access_token}"}
 
 
 # --- Mock CRUD operations ---
-@pytest_asyncio.fixture(scope="function", autouse=True)
+# The real objects behind every session-wide CRUD patch, so real_repositories can put them back
+_unpatched_targets: Dict[str, Any] = {}
+
+def _remember_unpatched(*target_maps: Dict[str, Any]):
+    for targets in target_maps:
+        for target in targets:
+            _unpatched_targets.setdefault(target, pkgutil.resolve_name(target))
+
+@pytest.fixture(scope="function")
+def real_repositories():
+    # Lifts the CRUD patches for one test, so it exercises the real repository code (against mongo_db)
+    with ExitStack() as stack:
+        for target, original in _unpatched_targets.items():
+            stack.enter_context(mock.patch(target, new=original))
+        yield
+
+@pytest_asyncio.fixture(scope="function")
+async def mongo_db(real_repositories):
+    # In-memory Motor stand-in with the real Beanie models and indexes
+    client = AsyncMongoMockClient(uuidRepresentation="standard")
+    database = client[f"faceswap_test_{uuid.uuid4().hex}"]
+    await init_beanie(database=database, document_models=[User, PaymentAttempt, Subscription])
+    yield database
+
+@pytest_asyncio.fixture(scope="session", autouse=True)
 async def mock_crud_user_operations(mock_user_db, mock_google_id_db):
     async def mock_get_user_by_email(email: str):
-        for user_instance in mock_user_db.values():
-            if user_instance.email == email:
-                return user_instance
-        return None
+        user_instance = mock_user_db.by_email.get(email)
+        # Entries are only added on assignment, so skip one left behind by an email change
+        return user_instance if user_instance is not None and user_instance.email == email else None
 
     async def mock_get_user_by_id(user_id: uuid.UUID):
         # Ensure user_id is uuid.UUID for dictionary lookup
@@ -138,43 +236,45 @@ async def mock_crud_user_operations(mock_user_db, mock_google_id_db):
         return mock_user_db.get(user_id)
 
 
-    async def mock_get_user_by_google_id(google_id: str):
-        return mock_google_id_db.get(google_id)
+    async def mock_get_user_by_google_id_or_email(google_id: str, email: str):
+        return mock_google_id_db.get(google_id) or await mock_get_user_by_email(email.lower())
 
+    # The mock stores build documents with model_construct: their inputs are already-validated request
+    # schemas and fixture values, so only the defaults (default_factory included) need applying.
     async def mock_create_user(user_in):
-        new_id = uuid.uuid4()
+        new_id = mock_uuid()
         user_data = {
             "id": new_id,
             "email": user_in.email.lower(),
-            "hashed_password": get_password_hash(user_in.password),
+            "hashed_password": cached_password_hash(user_in.password),
             "full_name": user_in.full_name if hasattr(user_in, 'full_name') else None,
-            "created_at": datetime.now(timezone.utc),
-            "updated_at": datetime.now(timezone.utc),
+            "created_at": mock_now(),
+            "updated_at": mock_now(),
             "is_active": True,
             "is_superuser": False,
             "subscription_type": "none",
             "free_requests_used": 0,
             "monthly_requests_used": 0
         }
-        user_instance = User(**user_data)
+        user_instance = User.model_construct(**user_data)
         mock_user_db[new_id] = user_instance
         return user_instance
 
     async def mock_create_user_google(user_in):
-        new_id = uuid.uuid4()
+        new_id = mock_uuid()
         user_data = {
             "id": new_id,
             "email": user_in.email.lower(),
             "google_id": user_in.google_id,
             "full_name": user_in.full_name if hasattr(user_in, 'full_name') else None,
             "is_active": True,
-            "created_at": datetime.now(timezone.utc),
-            "updated_at": datetime.now(timezone.utc),
+            "created_at": mock_now(),
+            "updated_at": mock_now(),
             "subscription_type": "none",
             "free_requests_used": 0,
             "monthly_requests_used": 0
         }
-        user_instance = User(**user_data)
+        user_instance = User.model_construct(**user_data)
         mock_user_db[new_id] = user_instance
         if user_in.google_id: # Ensure google_id exists before adding to this dict
             mock_google_id_db[user_in.google_id] = user_instance
@@ -182,24 +282,12 @@ async def mock_crud_user_operations(mock_user_db, mock_google_id_db):
     
     async def mock_save_user(user_instance: User): # Simulates user.save()
         if user_instance.id in mock_user_db:
-            user_instance.updated_at = datetime.now(timezone.utc)
+            user_instance.updated_at = mock_now()
             mock_user_db[user_instance.id] = user_instance
         if user_instance.google_id and user_instance.google_id in mock_google_id_db:
              mock_google_id_db[user_instance.google_id] = user_instance
         return user_instance 
     
-    async def mock_increment_user_request_count(user_instance: User, is_free_request: bool):
-        if is_free_request:
-            user_instance.free_requests_used += 1
-        else:
-            user_instance.monthly_requests_used += 1
-        user_instance.last_request_date = datetime.now(timezone.utc)
-        await mock_save_user(user_instance)
-
-    async def mock_reset_monthly_user_request_count(user_instance: User):
-        user_instance.monthly_requests_used = 0
-        await mock_save_user(user_instance)
-
     # Patch User.save as an instance method
     # For Beanie, model instance methods like save() are often better mocked
     # by patching the method on the class itself if all instances should use the mock.
@@ -210,29 +298,48 @@ async def mock_crud_user_operations(mock_user_db, mock_google_id_db):
     async def actual_user_save_mock(self_user_instance: User): # 'self' is the User instance
         return await mock_save_user(self_user_instance)
 
-    with mock.patch("app.repositories.user.get_user_by_email", side_effect=mock_get_user_by_email), \
-         mock.patch("app.repositories.user.get_user_by_id", side_effect=mock_get_user_by_id), \
-         mock.patch("app.repositories.user.get_user_by_google_id", side_effect=mock_get_user_by_google_id), \
-         mock.patch("app.repositories.user.create_user", side_effect=mock_create_user), \
-         mock.patch("app.repositories.user.create_user_google", side_effect=mock_create_user_google), \
-         mock.patch("app.models.user.User.save", new=actual_user_save_mock), \
-         mock.patch("app.repositories.user.increment_user_request_count", side_effect=mock_increment_user_request_count), \
-         mock.patch("app.repositories.user.reset_monthly_user_request_count", side_effect=mock_reset_monthly_user_request_count):
+    async def actual_user_set_mock(self_user_instance: User, expression: Dict, **kwargs): # Simulates user.set({...})
+        for field, value in expression.items():
+            setattr(self_user_instance, str(field), value)
+        return await mock_save_user(self_user_instance)
+
+    async def mock_mark_free_tier_used(user: User):
+        user.subscription_type = "free_tier_used"
+        mock_user_db[user.id] = user
+
+    side_effects = {
+        "app.repositories.user.get_user_by_email": mock_get_user_by_email,
+        "app.repositories.user.mark_free_tier_used": mock_mark_free_tier_used,
+        "app.repositories.user.get_user_auth_view_by_email": mock_get_user_by_email,
+        "app.repositories.user.get_user_by_id": mock_get_user_by_id,
+        "app.core.dependencies.get_user_by_id": mock_get_user_by_id, # Imported by name there
+        # The mock store holds the same instances record() bumps, so it already counts pending increments
+        "app.services.counter_batcher.counter_batcher.apply_pending": lambda user_instance: None,
+        "app.repositories.user.get_user_by_google_id_or_email": mock_get_user_by_google_id_or_email,
+        "app.repositories.user.create_user": mock_create_user,
+        "app.repositories.user.create_user_google": mock_create_user_google,
+    }
+    replacements = {
+        "app.models.user.User.save": actual_user_save_mock,
+        "app.models.user.User.set": actual_user_set_mock,
+    }
+    _remember_unpatched(side_effects, replacements)
+    with ExitStack() as stack:
+        for target, side_effect in side_effects.items():
+            stack.enter_context(mock.patch(target, side_effect=side_effect))
+        for target, replacement in replacements.items():
+            stack.enter_context(mock.patch(target, new=replacement))
         yield
 
-@pytest_asyncio.fixture(scope="function", autouse=True)
+@pytest_asyncio.fixture(scope="session", autouse=True)
 async def mock_crud_payment_operations(mock_user_db, mock_payment_attempt_db, mock_subscription_db):
-    from app.models.payment import PaymentAttempt, Subscription 
-    from app.models.user import User as UserModel # Alias to avoid confusion
-    from beanie.odm.fields import Link # Import Link for type checking
-
-    async def mock_create_payment_attempt(user: UserModel, amount, currency, payment_method, status="pending", **kwargs):
-        attempt_id = uuid.uuid4()
+    async def mock_create_payment_attempt(user: User, amount, currency, payment_method, status="pending", **kwargs):
+        attempt_id = mock_uuid()
         
         # Simulate Beanie's Link creation
-        user_ref = Link(document=user, document_type=UserModel)
+        user_ref = Link(document=user, document_type=User)
 
-        attempt = PaymentAttempt(
+        attempt = PaymentAttempt.model_construct(
             id=attempt_id,
             user=user_ref, 
             amount=amount,
@@ -242,52 +349,80 @@ async def mock_crud_payment_operations(mock_user_db, mock_payment_attempt_db, mo
             metadata=kwargs.get("metadata", {}),
             transaction_id=kwargs.get("transaction_id"),
             payment_processor=kwargs.get("payment_processor"),
-            created_at=datetime.now(timezone.utc), updated_at=datetime.now(timezone.utc)
+            created_at=mock_now(), updated_at=mock_now()
         )
         mock_payment_attempt_db[attempt_id] = attempt
         return attempt
 
+    async def mock_get_or_create_payment_attempt_by_reference(user: User, reference, payment_processor, amount, currency, metadata=None):
+        return await mock_get_payment_attempt_by_reference(reference, payment_processor) or await mock_create_payment_attempt(
+            user, amount, currency, "card", payment_processor=payment_processor, transaction_id=reference, metadata=metadata
+        )
+
     async def mock_get_payment_attempt(payment_attempt_id: uuid.UUID):
         return mock_payment_attempt_db.get(payment_attempt_id)
 
+    async def mock_get_payment_attempt_by_reference(reference: str, payment_processor: str):
+        for attempt in mock_payment_attempt_db.values():
+            if attempt.transaction_id == reference and attempt.payment_processor == payment_processor:
+                return attempt
+        return None
+
     async def mock_update_payment_attempt_status(payment_attempt, status, **kwargs):
         payment_attempt.status = status
         if "transaction_id" in kwargs:
             payment_attempt.transaction_id = kwargs["transaction_id"]
         if "metadata" in kwargs:
             payment_attempt.metadata = {**(payment_attempt.metadata or {}), **kwargs["metadata"]}
-        payment_attempt.updated_at = datetime.now(timezone.utc)
+        payment_attempt.updated_at = mock_now()
         mock_payment_attempt_db[payment_attempt.id] = payment_attempt 
         return payment_attempt
 
-    async def mock_create_or_update_subscription(user: UserModel, subscription_type, **kwargs):
-        sub_id = uuid.uuid4()
-        user_ref = Link(document=user, document_type=UserModel)
-
-        existing_sub_id = None
-        # Check if user object itself has subscription_id from mock_user_db
-        # or iterate mock_subscription_db
-        for sub_uuid_iter, sub_instance_iter in mock_subscription_db.items():
-            # Need to fetch the user from the Link to compare IDs if sub_instance_iter.user is a Link
-            # For simplicity, if user.id is directly comparable or we assume it's fetched.
-            # Let's assume the Link's document is already the user object for mock comparison
-            if isinstance(sub_instance_iter.user, Link) and sub_instance_iter.user.ref.id == user.id:
-                 existing_sub_id = sub_uuid_iter
-                 sub_id = existing_sub_id
-                 break
-            elif hasattr(sub_instance_iter.user, 'id') and sub_instance_iter.user.id == user.id: # If it's already a User object
-                 existing_sub_id = sub_uuid_iter
-                 sub_id = existing_sub_id
-                 break
-
-
-        start_date = kwargs.get("start_date", datetime.now(timezone.utc))
+    async def mock_mark_payment_attempt_succeeded(payment_attempt, transaction_id=None):
+        if payment_attempt.status == "succeeded":
+            return False
+        payment_attempt.status = "succeeded"
+        if transaction_id:
+            payment_attempt.transaction_id = transaction_id
+        mock_payment_attempt_db[payment_attempt.id] = payment_attempt
+        return True
+
+    async def mock_claim_payment_attempt(payment_attempt_id, user_id, transaction_id, payment_types):
+        attempt = mock_payment_attempt_db.get(payment_attempt_id)
+        if (
+            attempt is None
+            or attempt.user.ref.id != user_id
+            or attempt.status in ("succeeded", "failed")
+            or (attempt.metadata or {}).get("payment_type") not in payment_types
+        ):
+            return None
+        if any(other.transaction_id == transaction_id for other in mock_payment_attempt_db.values() if other is not attempt):
+            raise DuplicateKeyError("E11000 duplicate key error collection: payment_attempts index: transaction_id_1")
+        attempt.status = "succeeded"
+        attempt.transaction_id = transaction_id
+        attempt.updated_at = mock_now()
+        return attempt
+
+    async def mock_release_payment_attempt_claim(payment_attempt):
+        if payment_attempt.status == "succeeded":
+            payment_attempt.status = "pending"
+            payment_attempt.updated_at = mock_now()
+
+    async def mock_create_or_update_subscription(user: User, subscription_type, **kwargs):
+        sub_id = mock_uuid()
+        user_ref = Link(document=user, document_type=User)
+
+        existing_sub = mock_subscription_db.by_user.get(user.id)
+        if existing_sub is not None:
+            sub_id = existing_sub.id
+
+        start_date = kwargs.get("start_date") or mock_now()
         end_date = kwargs.get("end_date")
         if subscription_type == "monthly" and not end_date:
             end_date = start_date + timedelta(days=settings.MONTHLY_SUBSCRIPTION_DURATION_DAYS if hasattr(settings, 'MONTHLY_SUBSCRIPTION_DURATION_DAYS') else 30)
 
 
-        sub = Subscription(
+        sub = Subscription.model_construct(
             id=sub_id,
             user=user_ref,
             subscription_type=subscription_type,
@@ -296,7 +431,7 @@ async def mock_crud_payment_operations(mock_user_db, mock_payment_attempt_db, mo
             end_date=end_date,
             payment_processor_subscription_id=kwargs.get("payment_processor_subscription_id"),
             last_payment_date=start_date, 
-            created_at=datetime.now(timezone.utc), updated_at=datetime.now(timezone.utc)
+            created_at=mock_now(), updated_at=mock_now()
         )
         mock_subscription_db[sub_id] = sub
         
@@ -309,60 +444,63 @@ async def mock_crud_payment_operations(mock_user_db, mock_payment_attempt_db, mo
             user_in_db.subscription_end_date = end_date
             if subscription_type == "monthly":
                 user_in_db.monthly_requests_used = 0
+            refresh_access_state(user_in_db)
             mock_user_db[user.id] = user_in_db # Save changes back to the mock_user_db
         return sub
 
-    async def mock_get_user_subscription(user: UserModel):
-        for sub_instance in mock_subscription_db.values():
-            if isinstance(sub_instance.user, Link) and sub_instance.user.ref.id == user.id:
-                return sub_instance
-            elif hasattr(sub_instance.user, 'id') and sub_instance.user.id == user.id:
-                return sub_instance
-        return None
+    async def mock_get_user_subscription(user: User):
+        return mock_subscription_db.by_user.get(user.id)
         
-    with mock.patch("app.repositories.payment.create_payment_attempt", side_effect=mock_create_payment_attempt), \
-         mock.patch("app.repositories.payment.get_payment_attempt", side_effect=mock_get_payment_attempt), \
-         mock.patch("app.repositories.payment.update_payment_attempt_status", side_effect=mock_update_payment_attempt_status), \
-         mock.patch("app.repositories.payment.create_or_update_subscription", side_effect=mock_create_or_update_subscription), \
-         mock.patch("app.repositories.payment.get_user_subscription", side_effect=mock_get_user_subscription):
+    side_effects = {
+        "app.repositories.payment.create_payment_attempt": mock_create_payment_attempt,
+        "app.repositories.payment.get_payment_attempt": mock_get_payment_attempt,
+        "app.repositories.payment.update_payment_attempt_status": mock_update_payment_attempt_status,
+        "app.repositories.payment.mark_payment_attempt_succeeded": mock_mark_payment_attempt_succeeded,
+        "app.repositories.payment.claim_payment_attempt": mock_claim_payment_attempt,
+        "app.repositories.payment.release_payment_attempt_claim": mock_release_payment_attempt_claim,
+        "app.repositories.payment.get_payment_attempt_by_reference": mock_get_payment_attempt_by_reference,
+        "app.repositories.payment.get_or_create_payment_attempt_by_reference": mock_get_or_create_payment_attempt_by_reference,
+        "app.repositories.payment.create_or_update_subscription": mock_create_or_update_subscription,
+        "app.repositories.payment.get_user_subscription": mock_get_user_subscription,
+    }
+    _remember_unpatched(side_effects)
+    with ExitStack() as stack:
+        for target, side_effect in side_effects.items():
+            stack.enter_context(mock.patch(target, side_effect=side_effect))
         yield
 
 # Mock external services (Stripe, Google OAuth)
+_stripe_session_create = mock.AsyncMock()
+_stripe_session_retrieve = mock.AsyncMock()
+
 @pytest_asyncio.fixture(scope="function")
 async def mock_stripe():
-    with mock.patch("stripe.checkout.Session.create", new_callable=mock.AsyncMock) as mock_create, \
-         mock.patch("stripe.checkout.Session.retrieve", new_callable=mock.AsyncMock) as mock_retrieve:
+    _stripe_session_create.reset_mock(return_value=True, side_effect=True)
+    _stripe_session_retrieve.reset_mock(return_value=True, side_effect=True)
+    with mock.patch.multiple("stripe.checkout.Session", create=_stripe_session_create, retrieve=_stripe_session_retrieve):
         yield {
-            "create": mock_create,
-            "retrieve": mock_retrieve
+            "create": _stripe_session_create,
+            "retrieve": _stripe_session_retrieve
         }
 
+# Built once and reset per test. mock_google_oauth_client patches them in per test (rather than
+# for the session) so tests of the real _get_google_flow still see the unpatched function.
+_google_flow = mock.AsyncMock()
+_google_flow.authorization_url = mock.Mock(return_value=("https://mock.google.com/auth?client_id=test", "mock_state"))
+# fetch_token populates the flow's credentials rather than returning them
+_google_flow.fetch_token = mock.Mock()
+_google_flow.credentials = mock.Mock(id_token="mock_google_id_token_string")
+_google_verify_id_token = mock.Mock()
+
 @pytest_asyncio.fixture(scope="function")
 async def mock_google_oauth_client():
-    # This fixture mocks the `google_flow` object from `app.services.auth`
-    # and the `id_token.verify_oauth2_token` function.
-    
-    mock_flow_instance = mock.AsyncMock() # Use AsyncMock for flow if its methods are async
-    
-    # Mock authorization_url method
-    mock_flow_instance.authorization_url = mock.Mock(return_value=("https://mock.google.com/auth?client_id=test", "mock_state"))
-    
-    # Mock fetch_token method
-    # This method in google-auth-oauthlib typically doesn't return anything directly for the 'code' flow;
-    # it populates the flow instance's credentials.
-    mock_flow_instance.fetch_token = mock.Mock() # Not async if it's synchronous
-    
-    # Mock credentials attribute that fetch_token would populate
-    mock_credentials = mock.Mock()
-    mock_credentials.id_token = "mock_google_id_token_string"
-    mock_flow_instance.credentials = mock_credentials
-
-    # We also need to mock `google.oauth2.id_token.verify_oauth2_token`
-    # as it's called directly in the auth service.
-    with mock.patch("app.services.auth.google_flow", mock_flow_instance), \
-         mock.patch("app.services.auth.id_token.verify_oauth2_token") as mock_verify_id_token:
-        
+    # This fixture mocks the Flow returned by `_get_google_flow` in `app.services.auth`
+    # and the `id_token.verify_oauth2_token` function (imported lazily by the auth service).
+    _google_flow.reset_mock(side_effect=True) # Keeps authorization_url's return value
+    _google_verify_id_token.reset_mock(return_value=True, side_effect=True)
+    with mock.patch("app.services.auth._get_google_flow", return_value=_google_flow), \
+         mock.patch("google.oauth2.id_token.verify_oauth2_token", new=_google_verify_id_token):
         yield {
-            "flow": mock_flow_instance,
-            "verify_id_token": mock_verify_id_token # This is the mock for id_token.verify_oauth2_token
+            "flow": _google_flow,
+            "verify_id_token": _google_verify_id_token # This is the mock for id_token.verify_oauth2_token
         }
\ No newline at end of file
@@ -1,11 +1,37 @@
+import itertools
 import uuid
-from datetime import datetime, timedelta
+from functools import lru_cache
+from datetime import datetime, timedelta, timezone
 
 from app.models.user import User
 from app.models.payment import PaymentAttempt, Subscription
 from app.core.security import get_password_hash
 from app.core.config import settings
 
+# Mock timestamps come from one fake clock: anchored to the real time at import so expiry checks
+# against the app's clock still hold, then advanced by a microsecond per call so every write gets
+# a distinct, strictly increasing timestamp.
+_CLOCK_START = datetime.now(timezone.utc)
+_clock_ticks = itertools.count()
+
+def mock_now() -> datetime:
+    return _CLOCK_START + timedelta(microseconds=next(_clock_ticks))
+
+def mock_utcnow() -> datetime:
+    # Naive UTC, as the models store it
+    return mock_now().replace(tzinfo=None)
+
+# Sequential ids: deterministic across runs and no urandom read per mock document
+_uuid_counter = itertools.count(1)
+
+def mock_uuid() -> uuid.UUID:
+    return uuid.UUID(int=next(_uuid_counter))
+
+@lru_cache(maxsize=None)
+def cached_password_hash(password: str) -> str:
+    # Salted hashes still verify when shared, and tests only check that a password verifies
+    return get_password_hash(password)
+
 
 def create_mock_user(
     email="testuser@example.com",
@@ -21,9 +47,9 @@ def create_mock_user(
     user_id=None
 ) -> User:
     if user_id is None:
-        user_id = uuid.uuid4()
+        user_id = mock_uuid()
     
-    hashed_password = get_password_hash(password) if password else None
+    hashed_password = cached_password_hash(password) if password else None
     
     return User(
         id=user_id,
@@ -37,8 +63,8 @@ def create_mock_user(
         free_requests_used=free_requests_used,
         monthly_requests_used=monthly_requests_used,
         subscription_end_date=subscription_end_date,
-        created_at=datetime.utcnow(),
-        updated_at=datetime.utcnow()
+        created_at=mock_utcnow(),
+        updated_at=mock_utcnow()
     )
 
 def create_mock_payment_attempt(
@@ -50,17 +76,17 @@ def create_mock_payment_attempt(
     metadata=None
 ) -> PaymentAttempt:
     if metadata is None:
-        metadata = {"stripe_session_id": f"cs_test_{uuid.uuid4()}"}
+        metadata = {"stripe_session_id": f"cs_test_{mock_uuid()}"}
     return PaymentAttempt(
-        id=uuid.uuid4(),
+        id=mock_uuid(),
         user=user.to_ref(),
         amount=amount,
         currency=currency,
         payment_method=payment_method,
         status=status,
         metadata=metadata,
-        created_at=datetime.utcnow(),
-        updated_at=datetime.utcnow()
+        created_at=mock_utcnow(),
+        updated_at=mock_utcnow()
     )
 
 def create_mock_subscription(
@@ -68,18 +94,18 @@ def create_mock_subscription(
     subscription_type="one_time",
     status="active"
 ) -> Subscription:
-    start_date = datetime.utcnow()
+    start_date = mock_utcnow()
     end_date = None
     if subscription_type == "monthly":
         end_date = start_date + timedelta(days=30)
         
     return Subscription(
-        id=uuid.uuid4(),
+        id=mock_uuid(),
         user=user.to_ref(),
         subscription_type=subscription_type,
         status=status,
         start_date=start_date,
         end_date=end_date,
-        created_at=datetime.utcnow(),
-        updated_at=datetime.utcnow()
+        created_at=mock_utcnow(),
+        updated_at=mock_utcnow()
     )
\ No newline at end of file
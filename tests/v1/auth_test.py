@@ -7,6 +7,8 @@ from datetime import datetime, timedelta, timezone
 from app.core.config import settings
 from app.core.security import create_refresh_token, decode_token, create_access_token # Added create_access_token
 from app.schemas.token_schemas import TokenPayload
+from app.core.dependencies import _cached_decode_token
+from app.services import auth
 from app.models.user import User # Import User model for type hinting
 from tests.utils.mock_data import create_mock_user
 from typing import Dict
@@ -167,12 +169,12 @@ async def test_google_login_authorize_not_configured(client: AsyncClient):
     original_client_id = settings.GOOGLE_CLIENT_ID
     settings.GOOGLE_CLIENT_ID = None # Simulate not configured
     
-    # Temporarily replace the google_flow in auth_service for this test's scope
-    # auth.google_flow is initialized at module level, so we patch it there.
-    with mock.patch("app.services.auth.google_flow", None):
-        response = await client.get(f"{settings.API_V1_STR}/auth/google/login")
+    # The client config is lru_cached, so drop any config built by an earlier test
+    auth._get_google_client_config.cache_clear()
+    response = await client.get(f"{settings.API_V1_STR}/auth/google/login")
     
     settings.GOOGLE_CLIENT_ID = original_client_id # Reset
+    auth._get_google_client_config.cache_clear()
     
     assert response.status_code == 500
     data = response.json()
@@ -202,7 +204,7 @@ async def test_google_callback_new_user(client: AsyncClient, mock_google_oauth_c
     
     mock_google_oauth_client["flow"].fetch_token.assert_called_once_with(code="test_auth_code")
     mock_google_oauth_client["verify_id_token"].assert_called_once_with(
-        "mock_google_id_token_string", mock.ANY, settings.GOOGLE_CLIENT_ID
+        "mock_google_id_token_string", auth._get_google_auth_request(), settings.GOOGLE_CLIENT_ID
     )
     
     created_user = None
@@ -273,10 +275,30 @@ async def test_google_callback_invalid_code(client: AsyncClient, mock_google_oau
     assert data["error_code"] == "GOOGLE_TOKEN_ERROR"
     mock_google_oauth_client["flow"].fetch_token.assert_called_once_with(code="invalid_code")
 
+def test_google_auth_request_caches_certs():
+    transport = mock.Mock(return_value=mock.Mock(status=200))
+    caching_request = auth._CachingGoogleAuthRequest(transport)
+    certs_url = "https://www.googleapis.com/oauth2/v1/certs"
+    with mock.patch.dict(auth._google_certs_cache, clear=True):
+        first = caching_request(certs_url)
+        assert caching_request(certs_url) is first
+        caching_request("https://oauth2.googleapis.com/token", method="POST", body=b"")
+    assert transport.call_count == 2 # One certs download, one non-certs request
+
 
 @pytest.mark.asyncio
 async def test_logout(client: AsyncClient, auth_headers_for_user: Dict[str, str]):
     response = await client.post(f"{settings.API_V1_STR}/auth/logout", headers=auth_headers_for_user)
     assert response.status_code == 200
     data = response.json()
-    assert data["message"] == "Successfully logged out (client should delete token)"
\ No newline at end of file
+    assert data["message"] == "Successfully logged out (client should delete token)"
+
+@pytest.mark.asyncio
+async def test_cached_decode_token_decodes_once(test_user: User):
+    access_token = create_access_token(subject=test_user.id)
+    with mock.patch("app.core.dependencies.decode_token", wraps=decode_token) as mock_decode:
+        first_payload = _cached_decode_token(access_token)
+        second_payload = _cached_decode_token(access_token)
+    assert first_payload.sub == test_user.id
+    assert second_payload is first_payload
+    mock_decode.assert_called_once_with(access_token)
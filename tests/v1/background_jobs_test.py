@@ -0,0 +1,156 @@
+import asyncio
+import pytest
+from unittest import mock
+import uuid
+
+from pymongo.errors import AutoReconnect, BulkWriteError, ServerSelectionTimeoutError
+
+from app.core.config import settings
+from app.models.user import User
+from app.repositories.user import refresh_access_state
+from app.services.counter_batcher import CounterBatcher
+from tests.utils.mock_data import create_mock_user
+
+
+def _fake_users_collection(bulk_write: mock.AsyncMock) -> mock.Mock:
+    return mock.Mock(bulk_write=bulk_write)
+
+
+@pytest.mark.asyncio
+async def test_flush_sends_increments_and_derives_access_state_server_side():
+    batcher = CounterBatcher()
+    user = create_mock_user(email="batched@example.com")
+    batcher.record(user, is_free_request=True)
+    batcher.record(user, is_free_request=True)
+    assert user.free_requests_used == 2 # Applied in memory straight away
+
+    bulk_write = mock.AsyncMock()
+    with mock.patch.object(User, "get_motor_collection", return_value=_fake_users_collection(bulk_write)):
+        await batcher.flush()
+
+    operations = bulk_write.await_args.args[0]
+    assert len(operations) == 1
+    pipeline = operations[0]._doc
+    counters = pipeline[0]["$set"]
+    assert counters["free_requests_used"] == {"$add": [{"$ifNull": ["$free_requests_used", 0]}, 2]}
+    assert counters["monthly_requests_used"] == {"$add": [{"$ifNull": ["$monthly_requests_used", 0]}, 0]}
+    # Tier and remaining are computed from the stored counters, never copied from this worker's memory
+    derived = {field: stage["$set"][field] for stage in pipeline[1:] for field in stage["$set"]}
+    assert "$switch" in derived["effective_tier"]
+    assert "$switch" in derived["requests_remaining"]
+    assert isinstance(counters["counter_batch_id"], uuid.UUID)
+    assert batcher._pending == {} and batcher._inflight == {}
+
+
+@pytest.mark.asyncio
+async def test_flush_requeues_only_failed_ops():
+    batcher = CounterBatcher()
+    users = [create_mock_user(email=f"requeue{i}@example.com") for i in range(3)]
+    for user in users:
+        batcher.record(user, is_free_request=False)
+
+    error = BulkWriteError({"writeErrors": [{"index": 1, "code": 2, "errmsg": "failed"}], "nModified": 2})
+    with mock.patch.object(User, "get_motor_collection", return_value=_fake_users_collection(mock.AsyncMock(side_effect=error))):
+        with pytest.raises(BulkWriteError):
+            await batcher.flush()
+
+    assert list(batcher._pending) == [users[1].id]
+    assert batcher._pending[users[1].id].monthly == 1
+
+
+@pytest.mark.asyncio
+async def test_flush_requeues_everything_when_nothing_was_sent_and_merges_new_counts():
+    batcher = CounterBatcher()
+    user = create_mock_user(email="retry@example.com")
+    batcher.record(user, is_free_request=True)
+
+    async def fail_after_new_request(operations, ordered):
+        batcher.record(user, is_free_request=True) # Recorded while the batch is in flight
+        raise ServerSelectionTimeoutError("no primary")
+
+    with mock.patch.object(User, "get_motor_collection", return_value=_fake_users_collection(mock.AsyncMock(side_effect=fail_after_new_request))):
+        with pytest.raises(ServerSelectionTimeoutError):
+            await batcher.flush()
+
+    assert batcher._pending[user.id].free == 2
+
+
+@pytest.mark.asyncio
+async def test_flush_drops_a_batch_that_may_have_been_written():
+    batcher = CounterBatcher()
+    user = create_mock_user(email="ambiguous@example.com")
+    batcher.record(user, is_free_request=True)
+
+    # The reply was lost, so the increments may already be stored; retrying could count them twice
+    with mock.patch.object(User, "get_motor_collection", return_value=_fake_users_collection(mock.AsyncMock(side_effect=AutoReconnect("connection reset")))):
+        with pytest.raises(AutoReconnect):
+            await batcher.flush()
+
+    assert batcher._pending == {}
+
+
+@pytest.mark.asyncio
+async def test_cancelled_flush_still_finishes_its_write():
+    batcher = CounterBatcher()
+    user = create_mock_user(email="cancelled@example.com")
+    batcher.record(user, is_free_request=True)
+    release = asyncio.Event()
+    written = []
+
+    async def slow_write(operations, ordered):
+        await release.wait()
+        written.append(operations)
+
+    with mock.patch.object(User, "get_motor_collection", return_value=_fake_users_collection(mock.AsyncMock(side_effect=slow_write))):
+        flushing = asyncio.create_task(batcher.flush())
+        await asyncio.sleep(0)
+        flushing.cancel() # As stop() does to the flush loop
+        with pytest.raises(asyncio.CancelledError):
+            await flushing
+
+        release.set()
+        await batcher.flush() # Waits for the cancelled flush's write instead of dropping or resending it
+
+    assert len(written) == 1
+    assert batcher._pending == {} and batcher._inflight == {}
+
+
+@pytest.mark.asyncio
+async def test_apply_pending_adds_buffered_and_inflight_counts():
+    batcher = CounterBatcher()
+    user = create_mock_user(email="overlay@example.com")
+    batcher.record(user, is_free_request=True)
+    reloaded = user.model_copy(update={"free_requests_used": 0}) # As read back from Mongo
+
+    async def reload_during_flush(operations, ordered):
+        batcher.record(user, is_free_request=True)
+        in_flight_view = reloaded.model_copy()
+        batcher.apply_pending(in_flight_view)
+        assert in_flight_view.free_requests_used == 2 # One in flight, one buffered
+
+        # Read after the batch landed but before its ack: the stored count already includes it
+        landed_view = reloaded.model_copy(update={"free_requests_used": 1, "counter_batch_id": operations[0]._doc[0]["$set"]["counter_batch_id"]})
+        batcher.apply_pending(landed_view)
+        assert landed_view.free_requests_used == 2
+
+    with mock.patch.object(User, "get_motor_collection", return_value=_fake_users_collection(mock.AsyncMock(side_effect=reload_during_flush))):
+        await batcher.flush()
+
+
+@pytest.mark.asyncio
+async def test_flush_derives_access_state_from_stored_counters(mongo_db):
+    user = create_mock_user(email="derived@example.com")
+    refresh_access_state(user)
+    await user.insert()
+    # Another worker has used all but one free request; this instance still holds the old count
+    await User.get_motor_collection().update_one(
+        {"_id": user.id}, {"$set": {"free_requests_used": settings.FREE_REQUEST_LIMIT - 1}}
+    )
+    batcher = CounterBatcher()
+    batcher.record(user, is_free_request=True)
+    await batcher.flush()
+
+    stored = await User.get(user.id)
+    assert stored.free_requests_used == settings.FREE_REQUEST_LIMIT
+    assert stored.effective_tier == "free"
+    assert stored.requests_remaining == 0
\ No newline at end of file
@@ -1,14 +1,20 @@
+import asyncio
 import pytest
 from httpx import AsyncClient
 from unittest import mock
 import uuid
+import hashlib
+import hmac
+import orjson
 from typing import Dict
 from datetime import datetime, timedelta
 
 from app.core.config import settings
+from app.main import app
 from app.models.user import User
 from app.core.security import create_access_token
 from tests.utils.mock_data import create_mock_user # for specific payment states
+from app.utils.validators import is_valid_tx_hash
 
 @pytest.mark.asyncio
 async def test_payment_endpoints_no_auth(client: AsyncClient):
@@ -225,6 +231,28 @@ async def test_initiate_usdt_payment_one_time(client: AsyncClient, auth_headers_
     settings.USDT_ETH_WALLET_ADDRESS = None
 
 
+def test_msgspec_request_bodies_are_documented():
+    paths = app.openapi()["paths"]
+    for path in ("paystack/initialize-payment", "usdt/initiate-payment"):
+        request_body = paths[f"{settings.API_V1_STR}/payments/{path}"]["post"]["requestBody"]
+        schema = request_body["content"]["application/json"]["schema"]
+        assert schema["required"] == ["payment_type"]
+        assert set(schema["properties"]["payment_type"]["enum"]) == {"one_time", "monthly"}
+
+
+def test_msgspec_responses_are_documented():
+    paths = app.openapi()["paths"]
+    documented = {
+        "auth/login/email": ("post", "access_token"),
+        "auth/token/refresh": ("post", "access_token"),
+        "auth/google/callback": ("get", "access_token"),
+        "payments/paystack/initialize-payment": ("post", "authorization_url"),
+    }
+    for path, (method, field) in documented.items():
+        response = paths[f"{settings.API_V1_STR}/{path}"][method]["responses"]["200"]
+        assert field in response["content"]["application/json"]["schema"]["properties"]
+
+
 @pytest.mark.asyncio
 async def test_confirm_usdt_payment_success(
     client: AsyncClient, auth_headers_for_user: Dict[str, str], test_user: User, mock_user_db, mock_payment_attempt_db, mock_subscription_db
@@ -238,7 +266,7 @@ async def test_confirm_usdt_payment_success(
     )
     assert init_response.status_code == 200
     payment_attempt_id = init_response.json()["payment_attempt_id"]
-    tx_hash = f"0x{uuid.uuid4().hex}" # Mock transaction hash
+    tx_hash = f"0x{uuid.uuid4().hex}{uuid.uuid4().hex}" # Mock transaction hash (64 hex digits)
 
     # Now confirm it (mocking blockchain verification as successful in service)
     response = await client.post(
@@ -272,6 +300,47 @@ async def test_confirm_usdt_payment_success(
     settings.USDT_ETH_WALLET_ADDRESS = None
 
 
+@pytest.mark.asyncio
+async def test_confirm_usdt_payment_rejects_a_reused_tx_hash(client: AsyncClient, auth_headers_for_user: Dict[str, str], mock_payment_attempt_db, monkeypatch):
+    monkeypatch.setattr(settings, "USDT_ETH_WALLET_ADDRESS", "0xMockWalletAddress")
+    tx_hash = f"0x{uuid.uuid4().hex}{uuid.uuid4().hex}"
+    statuses = []
+    for _ in range(2): # Two attempts, both confirmed with the same hash
+        init_response = await client.post(
+            f"{settings.API_V1_STR}/payments/usdt/initiate-payment",
+            headers=auth_headers_for_user, json={"payment_type": "one_time"}
+        )
+        payment_attempt_id = init_response.json()["payment_attempt_id"]
+        response = await client.post(
+            f"{settings.API_V1_STR}/payments/usdt/confirm-payment?payment_attempt_id={payment_attempt_id}&transaction_hash={tx_hash}",
+            headers=auth_headers_for_user,
+        )
+        statuses.append(response.status_code)
+
+    assert statuses == [200, 409]
+    assert response.json()["error_code"] == "USDT_TX_HASH_ALREADY_USED"
+    assert mock_payment_attempt_db[uuid.UUID(payment_attempt_id)].status == "pending"
+
+
+@pytest.mark.asyncio
+async def test_confirm_usdt_payment_releases_claim_when_subscription_fails(test_user: User, mock_payment_attempt_db):
+    from app.services import payment as payment_service
+
+    settings.USDT_ETH_WALLET_ADDRESS = "0xMockWalletAddress"
+    try:
+        initiated = await payment_service.initiate_usdt_payment(test_user, "monthly")
+        tx_hash = f"0x{uuid.uuid4().hex}{uuid.uuid4().hex}"
+        with mock.patch("app.repositories.payment.create_or_update_subscription", side_effect=RuntimeError("db down")):
+            with pytest.raises(RuntimeError):
+                await payment_service.confirm_usdt_payment(test_user, initiated.payment_attempt_id, tx_hash)
+        # Not left succeeded without a subscription, so the confirmation can be retried
+        assert mock_payment_attempt_db[initiated.payment_attempt_id].status == "pending"
+        status = await payment_service.confirm_usdt_payment(test_user, initiated.payment_attempt_id, tx_hash)
+        assert status.subscription_type == "monthly"
+    finally:
+        settings.USDT_ETH_WALLET_ADDRESS = None
+
+
 @pytest.mark.asyncio
 async def test_get_payment_status_free_user_no_requests(
     client: AsyncClient, auth_headers_for_user: Dict[str, str], test_user: User
@@ -372,4 +441,188 @@ async def test_get_payment_status_monthly_subscriber_expired(
     data = response.json()
     assert data["subscription_type"] == "monthly" # Service doesn't change it here, just reports
     assert data["is_active_subscriber"] is False
-    assert "User's monthly subscription has expired." in data["message"]
\ No newline at end of file
+    assert "User's monthly subscription has expired." in data["message"]
+
+
+@pytest.mark.asyncio
+async def test_paystack_webhook_signature(client: AsyncClient, monkeypatch):
+    monkeypatch.setattr(settings, "PAYSTACK_SECRET_KEY", "sk_test_mock") # Restored even if an assert fails
+    payload = b'{"event": "transfer.success", "data": {"reference": "faceswap_ref"}}'
+    signature = hmac.new(settings.PAYSTACK_SECRET_KEY.encode(), payload, hashlib.sha512).hexdigest()
+
+    response = await client.post(
+        f"{settings.API_V1_STR}/payments/paystack/webhook", content=payload,
+        headers={"x-paystack-signature": "0" * len(signature)},
+    )
+    assert response.status_code == 401
+    assert response.json()["error_code"] == "PAYSTACK_WEBHOOK_INVALID_SIGNATURE"
+
+    response = await client.post(
+        f"{settings.API_V1_STR}/payments/paystack/webhook", content=payload,
+        headers={"x-paystack-signature": signature},
+    )
+    assert response.status_code == 200 # Signed, but not a charge event, so nothing to apply
+
+
+def _signed_charge_success(reference: str, user: User, amount: int) -> tuple:
+    payload = orjson.dumps({"event": "charge.success", "data": {
+        "reference": reference, "status": "success", "amount": amount, "currency": "USD",
+        "metadata": {"user_id": str(user.id), "payment_type": "monthly"},
+    }})
+    return payload, hmac.new(settings.PAYSTACK_SECRET_KEY.encode(), payload, hashlib.sha512).hexdigest()
+
+
+@pytest.mark.asyncio
+async def test_paystack_webhook_settles_before_acknowledging(client: AsyncClient, test_user: User, mock_payment_attempt_db, monkeypatch):
+    from app.repositories import payment as payment_repo
+    from app.services import payment as payment_service
+
+    monkeypatch.setattr(settings, "PAYSTACK_SECRET_KEY", "sk_test_mock")
+    attempt = await payment_repo.create_payment_attempt(
+        user=test_user, amount=10.0, currency="usd", payment_method="card", payment_processor="paystack",
+        transaction_id="faceswap_webhook_ref", metadata={"payment_type": "monthly"},
+    )
+    payload, signature = _signed_charge_success("faceswap_webhook_ref", test_user, payment_service._PAYMENT_PLANS["monthly"][0])
+
+    with mock.patch("app.services.payment._payment_owner", new=mock.AsyncMock(return_value=test_user)):
+        response = await client.post(
+            f"{settings.API_V1_STR}/payments/paystack/webhook", content=payload,
+            headers={"x-paystack-signature": signature},
+        )
+    assert response.status_code == 200
+    assert mock_payment_attempt_db[attempt.id].status == "succeeded"
+    assert test_user.subscription_type == "monthly"
+    assert "faceswap_webhook_ref" in payment_service._processed_paystack_webhooks
+    payment_service._processed_paystack_webhooks.pop("faceswap_webhook_ref", None)
+
+
+@pytest.mark.asyncio
+async def test_paystack_webhook_failure_is_not_marked_processed(test_user: User, mock_payment_attempt_db, monkeypatch):
+    from app.repositories import payment as payment_repo
+    from app.services import payment as payment_service
+
+    monkeypatch.setattr(settings, "PAYSTACK_SECRET_KEY", "sk_test_mock")
+    attempt = await payment_repo.create_payment_attempt(
+        user=test_user, amount=10.0, currency="usd", payment_method="card", payment_processor="paystack",
+        transaction_id="faceswap_failing_ref", metadata={"payment_type": "monthly"},
+    )
+    payload, signature = _signed_charge_success("faceswap_failing_ref", test_user, payment_service._PAYMENT_PLANS["monthly"][0])
+
+    with mock.patch("app.services.payment._payment_owner", new=mock.AsyncMock(return_value=test_user)):
+        with mock.patch("app.repositories.payment.create_or_update_subscription", side_effect=RuntimeError("db down")):
+            with pytest.raises(RuntimeError): # Surfaces as a 500, so Paystack redelivers
+                await payment_service.handle_paystack_webhook(payload, signature)
+        assert "faceswap_failing_ref" not in payment_service._processed_paystack_webhooks
+        assert mock_payment_attempt_db[attempt.id].status == "pending"
+
+        await payment_service.handle_paystack_webhook(payload, signature) # The redelivery applies it
+    assert mock_payment_attempt_db[attempt.id].status == "succeeded"
+    payment_service._processed_paystack_webhooks.pop("faceswap_failing_ref", None)
+
+
+@pytest.mark.asyncio
+async def test_paystack_webhook_stores_missing_attempt(test_user: User, mock_payment_attempt_db, monkeypatch):
+    from app.services import payment as payment_service
+
+    monkeypatch.setattr(settings, "PAYSTACK_SECRET_KEY", "sk_test_mock")
+    payload, signature = _signed_charge_success("faceswap_unstored_ref", test_user, payment_service._PAYMENT_PLANS["monthly"][0])
+
+    with mock.patch("app.services.payment._payment_owner", new=mock.AsyncMock(return_value=test_user)):
+        await payment_service.handle_paystack_webhook(payload, signature)
+
+    stored = [attempt for attempt in mock_payment_attempt_db.values() if attempt.transaction_id == "faceswap_unstored_ref"]
+    assert len(stored) == 1
+    assert stored[0].status == "succeeded"
+    assert stored[0].user.ref.id == test_user.id
+    assert test_user.subscription_type == "monthly"
+    payment_service._processed_paystack_webhooks.pop("faceswap_unstored_ref", None)
+
+
+@pytest.mark.asyncio
+async def test_verify_paystack_payment_stores_missing_attempt(test_user: User, mock_payment_attempt_db, monkeypatch):
+    from app.services import payment as payment_service
+
+    monkeypatch.setattr(settings, "PAYSTACK_SECRET_KEY", "sk_test_mock")
+    verify_response = mock.Mock(content=orjson.dumps({"status": True, "data": {
+        "reference": "faceswap_verify_ref", "status": "success", "currency": "USD",
+        "amount": payment_service._PAYMENT_PLANS["monthly"][0],
+        "metadata": {"user_id": str(test_user.id), "payment_type": "monthly"},
+    }}))
+    paystack_client = mock.Mock(get=mock.AsyncMock(return_value=verify_response))
+    with mock.patch("app.services.payment.get_paystack_client", return_value=paystack_client):
+        status = await payment_service.verify_paystack_payment("faceswap_verify_ref", test_user)
+
+    assert status.subscription_type == "monthly"
+    stored = [attempt for attempt in mock_payment_attempt_db.values() if attempt.transaction_id == "faceswap_verify_ref"]
+    assert len(stored) == 1 and stored[0].status == "succeeded"
+    payment_service._succeeded_paystack_references.pop("faceswap_verify_ref", None)
+
+
+def _slow_paystack_call(payload: dict) -> mock.AsyncMock:
+    async def respond(*args, **kwargs):
+        await asyncio.sleep(0.01) # Keeps the first call in flight while the second caller arrives
+        return mock.Mock(content=orjson.dumps(payload))
+    return mock.AsyncMock(side_effect=respond)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_paystack_initializations_share_one_stored_attempt(test_user: User, mock_payment_attempt_db, monkeypatch):
+    from app.services import payment as payment_service
+
+    monkeypatch.setattr(settings, "PAYSTACK_SECRET_KEY", "sk_test_mock")
+    post = _slow_paystack_call({"status": True, "data": {
+        "authorization_url": "https://checkout.paystack.com/abc", "access_code": "abc", "reference": "faceswap_shared_ref",
+    }})
+    with mock.patch("app.services.payment.get_paystack_client", return_value=mock.Mock(post=post)):
+        first, second = await asyncio.gather(
+            payment_service.initialize_paystack_payment(test_user, "monthly", "http://testserver"),
+            payment_service.initialize_paystack_payment(test_user, "monthly", "http://testserver"),
+        )
+
+    assert post.await_count == 1
+    assert first.reference == second.reference == "faceswap_shared_ref"
+    # Stored before either caller got the reference
+    stored = [attempt for attempt in mock_payment_attempt_db.values() if attempt.transaction_id == "faceswap_shared_ref"]
+    assert len(stored) == 1 and stored[0].status == "pending"
+    assert payment_service._inflight_paystack_initializations == {}
+
+
+@pytest.mark.asyncio
+async def test_concurrent_paystack_verifications_share_one_settlement(test_user: User, mock_payment_attempt_db, monkeypatch):
+    from app.repositories import payment as payment_repo
+    from app.services import payment as payment_service
+
+    monkeypatch.setattr(settings, "PAYSTACK_SECRET_KEY", "sk_test_mock")
+    attempt = await payment_repo.create_payment_attempt(
+        user=test_user, amount=10.0, currency="usd", payment_method="card", payment_processor="paystack",
+        transaction_id="faceswap_coalesced_ref", metadata={"payment_type": "monthly"},
+    )
+    get = _slow_paystack_call({"status": True, "data": {
+        "reference": "faceswap_coalesced_ref", "status": "success",
+        "amount": payment_service._PAYMENT_PLANS["monthly"][0], "metadata": {"user_id": str(test_user.id), "payment_type": "monthly"},
+    }})
+    subscription_writes = payment_repo.create_or_update_subscription.call_count
+    with mock.patch("app.services.payment.get_paystack_client", return_value=mock.Mock(get=get)):
+        first, second = await asyncio.gather(
+            payment_service.verify_paystack_payment("faceswap_coalesced_ref", test_user),
+            payment_service.verify_paystack_payment("faceswap_coalesced_ref", test_user),
+        )
+
+    assert get.await_count == 1
+    assert payment_repo.create_or_update_subscription.call_count == subscription_writes + 1
+    assert first.subscription_type == second.subscription_type == "monthly"
+    assert mock_payment_attempt_db[attempt.id].status == "succeeded"
+    assert payment_service._inflight_paystack_verifications == {}
+    payment_service._succeeded_paystack_references.pop("faceswap_coalesced_ref", None)
+
+
+@pytest.mark.parametrize("tx_hash, expected", [
+    ("0x" + "ab12" * 16, True),
+    ("0x" + "AB12" * 16, True),
+    ("0x" + "ab12" * 15, False), # Too short
+    ("ab" + "ab12" * 16, False), # Missing 0x prefix
+    ("0x" + "zz12" * 16, False), # Non-hex characters
+    ("0x" + "\u00e9" + "a" * 63, False), # Non-ASCII characters
+])
+def test_is_valid_tx_hash(tx_hash: str, expected: bool):
+    assert is_valid_tx_hash(tx_hash) is expected
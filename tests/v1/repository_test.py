@@ -0,0 +1,146 @@
+import asyncio
+import uuid
+import pytest
+from datetime import timedelta
+from beanie import init_beanie
+from bson import DBRef
+from mongomock_motor import AsyncMongoMockClient
+from pymongo.errors import DuplicateKeyError
+
+from app.core.dependencies import _get_user_with_pending
+from app.db.migrations import DUPLICATE_SUBSCRIPTIONS_COLLECTION, prepare_unique_indexes
+from app.models.user import User
+from app.models.payment import PaymentAttempt, Subscription
+from app.repositories import payment as payment_repo, user as user_repo
+from app.services.counter_batcher import counter_batcher
+from app.services.payment import VALID_PAYMENT_TYPES
+from app.utils.clock import utcnow
+from tests.utils.mock_data import create_mock_user
+
+# These run the real repository code against mongomock (see the mongo_db fixture), so the
+# guarded filters and updates are evaluated rather than replaced by the session-wide mocks.
+
+
+async def _stored_user(email: str, **fields) -> User:
+    user = create_mock_user(email=email, **fields)
+    user_repo.refresh_access_state(user)
+    return await user.insert()
+
+
+@pytest.mark.asyncio
+async def test_claim_payment_attempt_enforces_owner_status_and_type(mongo_db):
+    owner = await _stored_user("owner@example.com")
+    other = await _stored_user("other@example.com")
+    attempt = await payment_repo.create_payment_attempt(
+        user=owner, amount=29.99, currency="usdt", payment_method="usdt", metadata={"payment_type": "monthly"}
+    )
+    bogus = await payment_repo.create_payment_attempt(
+        user=owner, amount=29.99, currency="usdt", payment_method="usdt", metadata={"payment_type": "lifetime"}
+    )
+
+    assert await payment_repo.claim_payment_attempt(attempt.id, other.id, "0xaaa", VALID_PAYMENT_TYPES) is None
+    assert await payment_repo.claim_payment_attempt(bogus.id, owner.id, "0xbbb", VALID_PAYMENT_TYPES) is None
+
+    claimed = await payment_repo.claim_payment_attempt(attempt.id, owner.id, "0xaaa", VALID_PAYMENT_TYPES)
+    assert claimed.status == "succeeded"
+    assert claimed.transaction_id == "0xaaa"
+    assert await payment_repo.claim_payment_attempt(attempt.id, owner.id, "0xaaa", VALID_PAYMENT_TYPES) is None
+
+    # The unique transaction_id index stops one hash confirming a second attempt
+    second = await payment_repo.create_payment_attempt(
+        user=owner, amount=29.99, currency="usdt", payment_method="usdt", metadata={"payment_type": "monthly"}
+    )
+    with pytest.raises(DuplicateKeyError):
+        await payment_repo.claim_payment_attempt(second.id, owner.id, "0xaaa", VALID_PAYMENT_TYPES)
+
+
+@pytest.mark.asyncio
+async def test_guarded_status_updates_never_demote_a_succeeded_attempt(mongo_db):
+    owner = await _stored_user("guarded@example.com")
+    attempt = await payment_repo.create_payment_attempt(
+        user=owner, amount=29.99, currency="usd", payment_method="card", payment_processor="paystack",
+        transaction_id="faceswap_guarded_ref", metadata={"payment_type": "monthly"},
+    )
+
+    # Concurrent verifiers: exactly one wins the transition
+    copies = [await payment_repo.get_payment_attempt(attempt.id) for _ in range(3)]
+    results = await asyncio.gather(*(payment_repo.mark_payment_attempt_succeeded(copy) for copy in copies))
+    assert sorted(results) == [False, False, True]
+
+    # A late failure from a losing verifier is ignored
+    stale = await payment_repo.get_payment_attempt(attempt.id)
+    stale.status = "pending"
+    await payment_repo.update_payment_attempt_status(stale, status="failed", metadata={"error": "late"})
+    assert (await payment_repo.get_payment_attempt(attempt.id)).status == "succeeded"
+
+    # Releasing the claim (subscription write failed) makes it claimable again
+    await payment_repo.release_payment_attempt_claim(stale)
+    assert (await payment_repo.get_payment_attempt(attempt.id)).status == "pending"
+    assert await payment_repo.mark_payment_attempt_succeeded(stale) is True
+
+
+@pytest.mark.asyncio
+async def test_get_or_create_payment_attempt_by_reference_stores_one_attempt(mongo_db):
+    owner = await _stored_user("reference@example.com")
+    attempts = [
+        await payment_repo.get_or_create_payment_attempt_by_reference(
+            user=owner, reference="faceswap_once_ref", payment_processor="paystack", amount=29.99, currency="usd",
+            metadata={"payment_type": "monthly"},
+        )
+        for _ in range(2)
+    ]
+    assert attempts[0].id == attempts[1].id
+    assert await PaymentAttempt.find({"transaction_id": "faceswap_once_ref"}).count() == 1
+
+
+@pytest.mark.asyncio
+async def test_current_user_reads_access_state_written_elsewhere(mongo_db):
+    user = await _stored_user("current@example.com")
+    # Another worker activates a subscription
+    await User.get_motor_collection().update_one(
+        {"_id": user.id}, {"$set": {"subscription_type": "one_time", "effective_tier": "one_time"}}
+    )
+    loaded = await _get_user_with_pending(user.id)
+    assert loaded.subscription_type == "one_time"
+    assert loaded.effective_tier == "one_time"
+
+
+@pytest.mark.asyncio
+async def test_current_user_keeps_this_workers_pending_increments(mongo_db):
+    user = await _stored_user("pending@example.com")
+    try:
+        counter_batcher.record(user, is_free_request=True) # Buffered, not yet in Mongo
+        loaded = await _get_user_with_pending(user.id)
+        assert loaded is not user
+        assert loaded.free_requests_used == 1
+    finally:
+        counter_batcher._pending.pop(user.id, None)
+
+
+@pytest.mark.asyncio
+async def test_prepare_unique_indexes_dedupes_existing_data_so_the_indexes_build():
+    database = AsyncMongoMockClient(uuidRepresentation="standard")[f"faceswap_migration_{uuid.uuid4().hex}"]
+    now = utcnow().replace(microsecond=0)
+    await database["payment_attempts"].insert_many([
+        {"_id": uuid.uuid4(), "transaction_id": "0xdup", "status": "pending", "metadata": None, "created_at": now},
+        {"_id": uuid.uuid4(), "transaction_id": "0xdup", "status": "succeeded", "metadata": {"payment_type": "monthly"}, "created_at": now},
+    ])
+    owner = DBRef("users", uuid.uuid4())
+    await database["subscriptions"].insert_many([
+        {"_id": uuid.uuid4(), "user": owner, "updated_at": now - timedelta(days=1)},
+        {"_id": uuid.uuid4(), "user": owner, "updated_at": now},
+    ])
+
+    await prepare_unique_indexes(database)
+    await init_beanie(database=database, document_models=[User, PaymentAttempt, Subscription])
+
+    kept = await database["payment_attempts"].find_one({"transaction_id": "0xdup"})
+    assert kept["status"] == "succeeded"
+    moved = await database["payment_attempts"].find_one({"metadata.duplicate_transaction_id": "0xdup"})
+    assert moved["status"] == "pending" and "transaction_id" not in moved
+    assert (await database["subscriptions"].find_one({}))["updated_at"] == now
+    assert await database[DUPLICATE_SUBSCRIPTIONS_COLLECTION].count_documents({}) == 1
+
+    # Once the unique indexes exist the step leaves the data alone
+    await prepare_unique_indexes(database)
+    assert await database[DUPLICATE_SUBSCRIPTIONS_COLLECTION].count_documents({}) == 1